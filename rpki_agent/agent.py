@@ -18,14 +18,23 @@ import collections
 import datetime
 import filecmp
 import os
+import pkgutil
+import random
 import shutil
 import signal
+import struct
 import tempfile
+import time
 
 import eossdk
 
 from rpki_agent.base import RpkiBase
-from rpki_agent.listener import RpkiListener
+from rpki_agent.handoff import Handoff, HandoffError
+from rpki_agent.listener import RpkiHttpServer, RpkiListener
+from rpki_agent.metrics import metrics_name, Spans, write_metrics
+from rpki_agent.rtr import RtrWorker
+from rpki_agent.snapshot import Snapshot
+from rpki_agent.store import BodyStore
 from rpki_agent.worker import RpkiWorker
 
 
@@ -34,7 +43,15 @@ class RpkiAgent(RpkiBase, eossdk.AgentHandler, eossdk.TimeoutHandler,
     """An EOS SDK based agent that creates routing policy objects."""
 
     sysdb_mounts = ("agent",)
-    agent_options = ("cache_url", "refresh_interval")
+    agent_options = ("cache_url", "refresh_interval", "listener_mode",
+                     "listener_worker_class", "listener_workers",
+                     "listener_threads", "worker_processes", "persist_dir",
+                     "max_refresh_interval", "worker_mode", "delivery")
+    worker_modes = ("oneshot", "persistent")
+    deliveries = ("listener", "eapi")
+    # multiplier applied to the refresh interval per consecutive unchanged
+    # or failed fetch
+    backoff_factor = 2
 
     @classmethod
     def set_sysdb_mp(cls, name):
@@ -73,12 +90,28 @@ class RpkiAgent(RpkiBase, eossdk.AgentHandler, eossdk.TimeoutHandler,
         # set default confg options
         self._cache_url = None
         self._refresh_interval = 10
+        self._max_refresh_interval = 300
+        self._listener_mode = "fork"
+        self._listener_worker_class = "sync"
+        self._listener_workers = None
+        self._listener_threads = None
+        self._worker_processes = None
+        self._worker_mode = "oneshot"
+        self._delivery = "listener"
+        self._persist_dir = None
         # create state containers
         self._status = None
         self._last_start = None
         self._last_end = None
         self._result = None
+        self.unchanged = 0
+        self.failures = 0
         self.state = dict()
+        self.validators = dict()
+        self.data_dir = tempfile.mkdtemp(prefix="rpki-agent-")
+        self.snapshot = None
+        self.handoff = None
+        self.metrics = dict()
 
     @property
     def cache_url(self):
@@ -87,9 +120,34 @@ class RpkiAgent(RpkiBase, eossdk.AgentHandler, eossdk.TimeoutHandler,
 
     @cache_url.setter
     def cache_url(self, url):
-        """Set 'cache_url' property."""
+        """Set 'cache_url' property.
+
+        Several caches may be given, separated by commas or whitespace.
+        These are either all HTTP(S) JSON export URLs, or all RTR caches
+        given as 'rtr://host[:port]'.
+        """
+        if url:
+            rtr = set(u.startswith("rtr://")
+                      for u in url.replace(",", " ").split())
+            if len(rtr) > 1:
+                raise ValueError("cache_url cannot mix 'rtr://' and other "
+                                 "cache URLs")
         self._cache_url = url
 
+    @property
+    def cache_urls(self):
+        """Get the list of cache URLs in 'cache_url'."""
+        if self.cache_url is None:
+            return []
+        return self.cache_url.replace(",", " ").split()
+
+    @property
+    def worker_class(self):
+        """Get the worker class for the configured caches."""
+        if self.cache_urls and self.cache_urls[0].startswith("rtr://"):
+            return RtrWorker
+        return RpkiWorker
+
     @property
     def refresh_interval(self):
         """Get 'refresh_interval' property."""
@@ -107,6 +165,150 @@ class RpkiAgent(RpkiBase, eossdk.AgentHandler, eossdk.TimeoutHandler,
         else:
             raise ValueError("refresh_interval must be in range 1 - 86399")
 
+    @property
+    def max_refresh_interval(self):
+        """Get 'max_refresh_interval' property."""
+        return self._max_refresh_interval
+
+    @max_refresh_interval.setter
+    def max_refresh_interval(self, i):
+        """Set 'max_refresh_interval' property."""
+        if i:
+            i = int(i)
+        else:
+            i = 300
+        if i in range(10, 86400):
+            self._max_refresh_interval = i
+        else:
+            raise ValueError("max_refresh_interval must be in range "
+                             "10 - 86399")
+
+    @property
+    def listener_mode(self):
+        """Get 'listener_mode' property."""
+        return self._listener_mode
+
+    @listener_mode.setter
+    def listener_mode(self, mode):
+        """Set 'listener_mode' property."""
+        if not mode:
+            mode = "fork"
+        if mode in RpkiHttpServer.modes:
+            self._listener_mode = mode
+        else:
+            raise ValueError("listener_mode must be one of {}"
+                             .format(", ".join(RpkiHttpServer.modes)))
+
+    @property
+    def listener_worker_class(self):
+        """Get 'listener_worker_class' property."""
+        return self._listener_worker_class
+
+    @listener_worker_class.setter
+    def listener_worker_class(self, worker_class):
+        """Set 'listener_worker_class' property."""
+        if not worker_class:
+            worker_class = "sync"
+        if worker_class not in RpkiHttpServer.worker_classes:
+            raise ValueError("listener_worker_class must be one of {}"
+                             .format(", ".join(sorted(RpkiHttpServer
+                                                      .worker_classes))))
+        module = RpkiHttpServer.worker_classes[worker_class]
+        if module is not None and not importable(module):
+            raise ValueError("listener_worker_class '{}' requires '{}'"
+                             .format(worker_class, module))
+        self._listener_worker_class = worker_class
+
+    @property
+    def listener_workers(self):
+        """Get 'listener_workers' property."""
+        return self._listener_workers
+
+    @listener_workers.setter
+    def listener_workers(self, i):
+        """Set 'listener_workers' property."""
+        if i:
+            i = int(i)
+            if i not in range(1, 65):
+                raise ValueError("listener_workers must be in range 1 - 64")
+        self._listener_workers = i
+
+    @property
+    def listener_threads(self):
+        """Get 'listener_threads' property."""
+        return self._listener_threads
+
+    @listener_threads.setter
+    def listener_threads(self, i):
+        """Set 'listener_threads' property."""
+        if i:
+            i = int(i)
+            if i not in range(1, 257):
+                raise ValueError("listener_threads must be in range 1 - 256")
+        self._listener_threads = i
+
+    @property
+    def worker_processes(self):
+        """Get 'worker_processes' property."""
+        return self._worker_processes
+
+    @worker_processes.setter
+    def worker_processes(self, i):
+        """Set 'worker_processes' property."""
+        if i:
+            i = int(i)
+            if i not in range(1, 65):
+                raise ValueError("worker_processes must be in range 1 - 64")
+        self._worker_processes = i
+
+    @property
+    def worker_mode(self):
+        """Get 'worker_mode' property."""
+        return self._worker_mode
+
+    @worker_mode.setter
+    def worker_mode(self, mode):
+        """Set 'worker_mode' property."""
+        if not mode:
+            mode = "oneshot"
+        if mode in self.worker_modes:
+            self._worker_mode = mode
+        else:
+            raise ValueError("worker_mode must be one of {}"
+                             .format(", ".join(self.worker_modes)))
+
+    @property
+    def delivery(self):
+        """Get 'delivery' property."""
+        return self._delivery
+
+    @delivery.setter
+    def delivery(self, delivery):
+        """Set 'delivery' property.
+
+        With 'eapi', config objects are also pushed to the switch over
+        eAPI, in addition to being served by the listener.
+        """
+        if not delivery:
+            delivery = "listener"
+        if delivery in self.deliveries:
+            self._delivery = delivery
+        else:
+            raise ValueError("delivery must be one of {}"
+                             .format(", ".join(self.deliveries)))
+
+    @property
+    def persist_dir(self):
+        """Get 'persist_dir' property."""
+        return self._persist_dir
+
+    @persist_dir.setter
+    def persist_dir(self, path):
+        """Set 'persist_dir' property."""
+        if path and not os.path.isabs(path):
+            raise ValueError("persist_dir must be an absolute path")
+        self._persist_dir = path
+
     @property
     def status(self):
         """Get 'status' property."""
@@ -128,6 +330,8 @@ class RpkiAgent(RpkiBase, eossdk.AgentHandler, eossdk.TimeoutHandler,
     def result(self, r):
         """Set 'result' property."""
         self._result = r
+        self.unchanged = self.unchanged + 1 if r == "unchanged" else 0
+        self.failures = self.failures + 1 if r == "failed" else 0
         self.agent_mgr.status_set("result", self.result)
         self.notice("Result: {}".format(self.result))
 
@@ -187,8 +391,25 @@ class RpkiAgent(RpkiBase, eossdk.AgentHandler, eossdk.TimeoutHandler,
         """Start up the Listener."""
         try:
             self.info("Initialising listener")
-            self.listener = RpkiListener()
+            self.listener = RpkiListener(
+                mode=self.listener_mode,
+                data_dir=self.data_dir,
+                worker_class=self.listener_worker_class,
+                workers=self.listener_workers,
+                threads=self.listener_threads)
+            # a new listener has no data, so hand it the current processed
+            # snapshot, or else the persisted one, to serve straight away.
+            # the next fetch must not be skipped as unchanged, so that it
+            # is checked against the live export.
+            self.validators = dict()
+            if self.snapshot is None:
+                self.snapshot = self.restore_snapshot()
+            self.handoff = None
+            if self.snapshot is not None:
+                self.hand_off(self.snapshot)
+            self.watch(self.listener.p_data, "ack")
             self.watch(self.listener.p_err, "error")
+            self.watch(self.listener.p_refresh, "refresh")
             self.info("Starting listener")
             self.listener.start()
             self.info("Listener started: pid {}".format(self.listener.pid))
@@ -196,19 +417,62 @@ class RpkiAgent(RpkiBase, eossdk.AgentHandler, eossdk.TimeoutHandler,
             self.err("Starting listener failed: {}".format(e))
             raise e
 
+    @property
+    def busy(self):
+        """Check whether the worker is currently fetching VRP data."""
+        if self.worker is None or not self.worker.is_alive():
+            return False
+        if self.worker.persistent and not self.worker.follows:
+            return self.status == "running"
+        return True
+
     def run(self):
-        """Spawn worker process to retrieve VRP data."""
+        """Spawn worker process to retrieve VRP data.
+
+        A persistent worker that is still running with the current options
+        is re-used: if it follows the cache itself it is left alone,
+        otherwise it is sent a 'refresh' command.
+        """
+        if self.busy and not self.worker.follows:
+            self.info("Worker already running: pid {}"
+                      .format(self.worker.pid))
+            return
+        if (self.worker is not None and self.worker.persistent and
+                self.worker.is_alive()):
+            if self.reusable(self.worker):
+                if self.worker.follows:
+                    return self.follow()
+                self.status = "running"
+                self.last_start = datetime.datetime.now()
+                self.info("Sending refresh command to worker")
+                self.worker.p_data.send(("refresh", time.time(),
+                                         self.validators, self.snapshot))
+                return
+            self.info("Worker options changed: stopping worker")
+        if self.worker is not None and (self.worker.is_alive() or
+                                        self.worker.p_data in self.watching):
+            self.cleanup(process=self.worker)
         self.status = "running"
         if self.cache_url is not None:
             self.last_start = datetime.datetime.now()
             try:
                 self.info("Initialising worker")
-                self.worker = RpkiWorker(cache_url=self.cache_url)
+                self.worker = self.worker_class(
+                    cache_urls=self.cache_urls,
+                    data_dir=self.data_dir,
+                    validators=self.validators,
+                    previous=self.snapshot,
+                    processes=self.worker_processes,
+                    persist_dir=self.persist_dir,
+                    persistent=(self.worker_mode == "persistent"),
+                    delivery=self.delivery)
                 self.watch(self.worker.p_data, "result")
                 self.watch(self.worker.p_err, "error")
                 self.info("Starting worker")
                 self.worker.start()
                 self.info("Worker started: pid {}".format(self.worker.pid))
+                if self.worker.follows:
+                    self.follow()
             except Exception as e:
                 self.err("Starting worker failed: {}".format(e))
                 self.failure(err=e)
@@ -216,6 +480,16 @@ class RpkiAgent(RpkiBase, eossdk.AgentHandler, eossdk.TimeoutHandler,
             self.warning("'cache_url' is not set".format(self.cache_url))
             self.sleep()
 
+    def reusable(self, worker):
+        """Check whether a running worker matches the current options."""
+        return (worker.__class__ is self.worker_class and
+                worker.cache_urls == self.cache_urls and
+                worker.processes == (self.worker_processes or 1) and
+                worker.persist_dir == self.persist_dir and
+                worker.delivery == self.delivery and
+                (worker.follows or
+                 worker.persistent == (self.worker_mode == "persistent")))
+
     def watch(self, conn, type):
         """Watch a Connection for new data."""
         self.info("Trying to watch for {} data on {}".format(type, conn))
@@ -240,16 +514,34 @@ class RpkiAgent(RpkiBase, eossdk.AgentHandler, eossdk.TimeoutHandler,
         """Process VRP data."""
         self.status = "finalising"
         self.info("Receiving results from worker")
-        (stats, vrps) = self.worker.data
-        self.info("Sending listener HUP signal")
-        os.kill(self.listener.pid, signal.SIGHUP)
-        self.info("Sending new VRP set to listener")
-        self.listener.p_data.send(vrps)
-        self.report(**stats)
-        self.result = "ok"
+        (stats, snapshot, self.validators) = self.worker.data
+        spans = Spans()
+        if snapshot is None:
+            self.info("VRP set unchanged: skipping listener reload")
+            self.result = "unchanged"
+        else:
+            with spans.span("handoff"):
+                # the snapshot is ready to be received before the listener
+                # is signalled to reload
+                self.hand_off(snapshot)
+                if self.listener.mode == "fork":
+                    self.info("Sending listener HUP signal")
+                    os.kill(self.listener.pid, signal.SIGHUP)
+                self.remove_snapshot()
+            self.snapshot = snapshot
+            self.result = "ok"
         self.last_end = datetime.datetime.now()
-        self.cleanup(process=self.worker)
-        self.sleep()
+        stats.update(spans.stats)
+        if self.last_start is not None and not self.worker.follows:
+            stats["cycle_ms"] = int((self.last_end - self.last_start)
+                                    .total_seconds() * 1000)
+        self.report(**stats)
+        if self.worker.follows:
+            self.follow()
+        else:
+            if not self.worker.persistent:
+                self.cleanup(process=self.worker)
+            self.sleep()
 
     def failure(self, err=None, process=None, restart=False):
         """Handle worker exception."""
@@ -267,14 +559,87 @@ class RpkiAgent(RpkiBase, eossdk.AgentHandler, eossdk.TimeoutHandler,
         if restart:
             self.restart()
         else:
-            self.cleanup(process=process)
+            # a persistent worker survives a failed cycle
+            if not (process is self.worker and process.persistent and
+                    not process.follows and process.is_alive()):
+                self.cleanup(process=process)
             self.sleep()
 
+    def restore_snapshot(self):
+        """Restore the processed snapshot persisted in 'persist_dir'."""
+        if self.persist_dir is None:
+            return None
+        self.info("Restoring snapshot from {}".format(self.persist_dir))
+        try:
+            snapshot = Snapshot.restore(self.persist_dir, self.data_dir)
+        except (IOError, OSError, ValueError, struct.error) as e:
+            self.warning("Restoring snapshot failed: {}".format(e))
+            return None
+        if snapshot is None:
+            self.info("No persisted snapshot found")
+            return None
+        with BodyStore(snapshot.bodies) as store:
+            self.report(**store.metadata)
+        self.notice("Restored snapshot {}".format(snapshot.generation))
+        return snapshot
+
+    def hand_off(self, snapshot):
+        """Send a processed snapshot to the listener."""
+        if self.handoff is not None:
+            self.warning("Listener has not confirmed loading snapshot {}"
+                         .format(self.handoff[0]))
+        self.info("Sending processed snapshot {} to listener"
+                  .format(snapshot.generation))
+        self.listener.p_data.send_snapshot(snapshot)
+        self.handoff = (snapshot.generation, time.time())
+
+    def confirm(self):
+        """Handle confirmations of loaded snapshots from the listener.
+
+        The time from sending the snapshot for which the latest
+        confirmation is received is reported as 'listener_handoff_ms',
+        along with the stage timings reported by the listener.
+        """
+        try:
+            for (kind, generation, info) in self.listener.p_data.frames():
+                if kind != Handoff.ack:
+                    continue
+                self.info("Listener loaded snapshot {}".format(generation))
+                stats = dict(info)
+                stats["listener_generation"] = generation
+                if (self.handoff is not None and
+                        self.handoff[0] == generation):
+                    stats["listener_handoff_ms"] = \
+                        int((time.time() - self.handoff[1]) * 1000)
+                    self.handoff = None
+                self.report(**stats)
+        except (EOFError, HandoffError) as e:
+            self.warning("Listener confirmation channel failed: {}"
+                         .format(e))
+            self.unwatch(self.listener.p_data)
+
+    def remove_snapshot(self):
+        """Remove the files of the current processed snapshot."""
+        if self.snapshot is not None:
+            for path in (self.snapshot.vrps, self.snapshot.bodies):
+                self.info("Removing snapshot file {}".format(path))
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    self.warning(e)
+        self.snapshot = None
+
     def report(self, **stats):
         """Report statistics to the agent manager."""
         for name, value in stats.items():
             self.info("{}: {}".format(name, value))
             self.agent_mgr.status_set(name, str(value))
+        self.metrics.update(stats)
+        try:
+            write_metrics(os.path.join(self.data_dir, metrics_name),
+                          self.metrics)
+        except (IOError, OSError) as e:
+            self.warning("Writing metrics failed: {}".format(e))
 
     def cleanup(self, process):
         """Kill the process if it is still running."""
@@ -299,8 +664,54 @@ class RpkiAgent(RpkiBase, eossdk.AgentHandler, eossdk.TimeoutHandler,
         self.info("Cleanup complete")
 
     def sleep(self):
-        """Go to sleep for 'refresh_interval' seconds."""
+        """Go to sleep until the next scheduled refresh."""
         self.status = "sleeping"
+        interval = self.next_interval()
+        self.info("Next refresh in {:.1f} seconds".format(interval))
+        self.timeout_time_is(eossdk.now() + interval)
+
+    def next_interval(self):
+        """Get the number of seconds until the next refresh.
+
+        Each consecutive unchanged fetch multiplies 'refresh_interval' by
+        'backoff_factor', up to 'max_refresh_interval'. Consecutive
+        failures back off in the same way, with the interval randomly
+        jittered over its upper half so that agents do not retry a failed
+        cache in step.
+        """
+        ceiling = max(self.refresh_interval, self.max_refresh_interval)
+        if self.failures:
+            interval = min(ceiling, self.refresh_interval *
+                           self.backoff_factor ** min(self.failures - 1, 32))
+            return random.uniform(interval / 2.0, interval)
+        return min(ceiling, self.refresh_interval *
+                   self.backoff_factor ** min(self.unchanged, 32))
+
+    def refresh(self):
+        """Refresh immediately, on a trigger received from the listener."""
+        reason = None
+        try:
+            while self.listener.p_refresh.poll():
+                reason = self.listener.p_refresh.recv()
+        except EOFError:
+            self.warning("Refresh trigger channel closed")
+            self.unwatch(self.listener.p_refresh)
+            return
+        if reason is None:
+            return
+        self.notice("Refresh triggered by {}".format(reason))
+        if self.busy:
+            self.info("Worker is already running: ignoring trigger")
+            return
+        self.unchanged = 0
+        self.run()
+
+    def follow(self):
+        """Wait for updates from a persistent worker.
+
+        The worker is checked again after 'refresh_interval' seconds.
+        """
+        self.status = "following"
         self.timeout_time_is(eossdk.now() + self.refresh_interval)
 
     def shutdown(self):
@@ -309,6 +720,7 @@ class RpkiAgent(RpkiBase, eossdk.AgentHandler, eossdk.TimeoutHandler,
         try:
             self.cleanup(process=self.worker)
             self.cleanup(process=self.listener)
+            shutil.rmtree(self.data_dir, ignore_errors=True)
         except Exception as e:
             self.err(e)
         self.status = "shutdown"
@@ -348,7 +760,13 @@ class RpkiAgent(RpkiBase, eossdk.AgentHandler, eossdk.TimeoutHandler,
     def on_readable(self, fd):
         """Handle a watched file descriptor becoming readable."""
         self.info("Watched file descriptor {} is readable".format(fd))
-        if fd == self.worker.p_data.fileno():
+        if fd == self.listener.p_refresh.fileno():
+            self.info("Refresh trigger received from listener")
+            return self.refresh()
+        elif fd == self.listener.p_data.fileno():
+            self.info("Confirmation received from listener")
+            return self.confirm()
+        elif fd == self.worker.p_data.fileno():
             self.info("Data channel is ready")
             return self.success()
         elif fd == self.worker.p_err.fileno():
@@ -359,3 +777,11 @@ class RpkiAgent(RpkiBase, eossdk.AgentHandler, eossdk.TimeoutHandler,
             return self.failure(process=self.listener, restart=True)
         else:
             self.warning("Unknown file descriptor: ignoring")
+
+
+def importable(name):
+    """Check whether a module can be imported, without importing it."""
+    try:
+        return pkgutil.find_loader(name) is not None
+    except ImportError:
+        return False
@@ -0,0 +1,55 @@
+# Copyright (c) 2019 Ben Maddison. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""rpki_agent prefix aggregation."""
+
+from __future__ import print_function
+
+
+def aggregate(networks, width):
+    """Aggregate (address, length) pairs into the minimal covering set.
+
+    'networks' is an iterable of (address, length) pairs, where address is
+    an integer and 'width' is the address size in bits. The union of the
+    networks is merged into maximal address ranges with a single sorted
+    pass, and each range is then split into the fewest aligned prefixes.
+    Any host bits set in an address are ignored. Returns a sorted list of
+    (address, length) pairs.
+    """
+    intervals = sorted((address >> (width - length) << (width - length),
+                        address | ((1 << (width - length)) - 1))
+                       for address, length in networks)
+    aggregated = list()
+    if not intervals:
+        return aggregated
+    (start, end) = intervals[0]
+    for (next_start, next_end) in intervals[1:]:
+        if next_start <= end + 1:
+            if next_end > end:
+                end = next_end
+        else:
+            aggregated.extend(_range_prefixes(start, end, width))
+            (start, end) = (next_start, next_end)
+    aggregated.extend(_range_prefixes(start, end, width))
+    return aggregated
+
+
+def _range_prefixes(start, end, width):
+    """Yield the fewest aligned prefixes that exactly cover a range."""
+    while start <= end:
+        if start:
+            # the size of the largest block aligned at 'start'
+            bits = (start & -start).bit_length() - 1
+        else:
+            bits = width
+        bits = min(bits, (end - start + 1).bit_length() - 1)
+        yield (start, width - bits)
+        start += 1 << bits
@@ -0,0 +1,163 @@
+# Copyright (c) 2019 Ben Maddison. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""rpki_agent validator export parsing."""
+
+from __future__ import print_function
+
+import calendar
+import codecs
+import datetime
+import json
+import re
+
+
+class ExportStream(object):
+    """Incrementally decode the JSON export of an RPKI validation cache.
+
+    Iterating over an ExportStream yields the members of the 'roas' array
+    one at a time, reading from the underlying iterable of byte chunks only
+    as far as is necessary to decode the next entry. Any other top-level
+    members of the export are decoded whole and made available in
+    'metadata'.
+
+    No single value may span more than 'max_value_size' characters of
+    input, so that malformed input is reported without buffering the rest
+    of the stream.
+    """
+
+    whitespace = re.compile(r"[ \t\n\r]*")
+    # characters that may continue a number after it has been decoded
+    number_tail = re.compile(r"[0-9.eE+-]*")
+    max_value_size = 16 * 1024 * 1024
+
+    def __init__(self, chunks, key="roas", encoding="utf-8"):
+        """Initialise an ExportStream instance."""
+        self.chunks = iter(chunks)
+        self.key = key
+        self.metadata = dict()
+        self.decoder = json.JSONDecoder()
+        self._decode = codecs.getincrementaldecoder(encoding)()
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        """Read the next chunk into the buffer."""
+        if self._eof:
+            return False
+        # drop the already consumed part of the buffer
+        self._buf = self._buf[self._pos:]
+        self._pos = 0
+        for chunk in self.chunks:
+            text = self._decode.decode(chunk)
+            if text:
+                self._buf += text
+                return True
+        self._buf += self._decode.decode(b"", True)
+        self._eof = True
+        return False
+
+    def _peek(self):
+        """Skip whitespace and return the next character."""
+        while True:
+            self._pos = self.whitespace.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of export data")
+
+    def _expect(self, chars):
+        """Consume the next character, which must be one of 'chars'."""
+        char = self._peek()
+        if char not in chars:
+            raise ValueError("Expected one of '{}' at offset {}, got '{}'"
+                             .format(chars, self._pos, char))
+        self._pos += 1
+        return char
+
+    def _value(self):
+        """Decode the next complete JSON value."""
+        char = self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if not self._more():
+                    raise
+                continue
+            # a number running to the end of the buffer may not be
+            # complete yet, e.g. '-12.' of '-12.75' decodes as -12
+            if (char in "-0123456789" and
+                    self.number_tail.match(self._buf, end).end() ==
+                    len(self._buf) and self._more()):
+                continue
+            self._pos = end
+            return value
+
+    def _more(self):
+        """Read more of a value that may be incomplete.
+
+        Returns False at the end of the stream, and raises ValueError if
+        the value is already longer than 'max_value_size'.
+        """
+        if len(self._buf) - self._pos > self.max_value_size:
+            raise ValueError("Value at offset {} is longer than {} "
+                             "characters".format(self._pos,
+                                                 self.max_value_size))
+        return self._fill()
+
+    def __iter__(self):
+        """Yield each entry of the 'roas' array in turn."""
+        self._expect("{")
+        if self._peek() == "}":
+            return
+        while True:
+            key = self._value()
+            self._expect(":")
+            if key == self.key:
+                self._expect("[")
+                if self._peek() == "]":
+                    self._pos += 1
+                else:
+                    while True:
+                        yield self._value()
+                        if self._expect(",]") == "]":
+                            break
+            else:
+                self.metadata[key] = self._value()
+            if self._expect(",}") == "}":
+                return
+
+
+def export_time(members):
+    """Get the generation time of an export, if known.
+
+    'members' are the top-level members of the export other than 'roas',
+    as collected in ExportStream.metadata. Returns seconds since the
+    epoch, or None. Both the 'generated' epoch time of routinator style
+    exports and the ISO 8601 'buildtime' of rpki-client style exports are
+    understood.
+    """
+    metadata = members.get("metadata", {})
+    if not isinstance(metadata, dict):
+        return None
+    generated = metadata.get("generated")
+    if isinstance(generated, (int, float)):
+        return float(generated)
+    for key in ("generatedTime", "buildtime"):
+        try:
+            ts = datetime.datetime.strptime(metadata[key],
+                                            "%Y-%m-%dT%H:%M:%SZ")
+        except (KeyError, TypeError, ValueError):
+            continue
+        return float(calendar.timegm(ts.utctimetuple()))
+    return None
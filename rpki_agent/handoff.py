@@ -0,0 +1,135 @@
+# Copyright (c) 2019 Ben Maddison. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""rpki_agent snapshot handoff protocol."""
+
+from __future__ import print_function
+
+import json
+import select
+import socket
+import struct
+import time
+
+from rpki_agent.base import RpkiBase
+from rpki_agent.snapshot import Snapshot
+
+
+class HandoffError(Exception):
+    """Raised when a handoff frame cannot be received."""
+
+
+class Handoff(RpkiBase):
+    """One end of the framed handoff channel between agent and listener.
+
+    Each frame consists of a fixed header, giving the frame type, the
+    snapshot generation and the payload length, followed by a JSON
+    payload:
+
+        snapshot: agent to listener, the fields of a processed Snapshot
+        ack:      listener to agent, the generation it has loaded
+
+    A frame is only read once its first byte is ready, and the rest of it
+    is then read within 'timeout' seconds, with progress traced every
+    'progress_size' bytes.
+    """
+
+    magic = b"RPKH"
+    header = struct.Struct("!4sBQI")
+    snapshot, ack = 1, 2
+    timeout = 30
+    progress_size = 1024 * 1024
+
+    def __init__(self, sock):
+        """Initialise a Handoff instance on one end of a socket pair."""
+        RpkiBase.__init__(self)
+        self.sock = sock
+
+    @classmethod
+    def pair(cls):
+        """Create a connected pair of Handoff instances."""
+        (a, b) = socket.socketpair()
+        return (cls(a), cls(b))
+
+    def fileno(self):
+        """Get the file descriptor of the underlying socket."""
+        return self.sock.fileno()
+
+    def close(self):
+        """Close the underlying socket."""
+        self.sock.close()
+
+    def send(self, kind, generation, payload):
+        """Send a single frame."""
+        data = json.dumps(payload, sort_keys=True).encode("utf-8")
+        self.sock.sendall(self.header.pack(self.magic, kind, generation,
+                                           len(data)) + data)
+
+    def send_snapshot(self, snapshot):
+        """Send a processed Snapshot."""
+        self.send(self.snapshot, snapshot.generation, dict(snapshot._asdict()))
+
+    def send_ack(self, generation, **info):
+        """Confirm that a snapshot generation has been loaded."""
+        self.send(self.ack, generation, info)
+
+    def ready(self, timeout=0):
+        """Wait up to 'timeout' seconds (or forever if None) for a frame."""
+        (readable, _, _) = select.select([self.sock], [], [], timeout)
+        return bool(readable)
+
+    def recv(self):
+        """Receive a single frame, as a (type, generation, payload) tuple.
+
+        Raises EOFError if the channel is closed before a frame starts, and
+        HandoffError if a frame is invalid or is not complete in time.
+        """
+        deadline = time.time() + self.timeout
+        head = self._read(self.header.size, deadline, start=True)
+        (magic, kind, generation, length) = self.header.unpack(head)
+        if magic != self.magic:
+            raise HandoffError("Invalid handoff frame header")
+        payload = json.loads(self._read(length, deadline).decode("utf-8"))
+        if kind == self.snapshot:
+            payload = Snapshot(**payload)
+        return (kind, generation, payload)
+
+    def frames(self):
+        """Yield each frame that is ready to be received, without waiting."""
+        while self.ready():
+            yield self.recv()
+
+    def _read(self, size, deadline, start=False):
+        """Read exactly 'size' bytes before 'deadline'.
+
+        If 'start' is set, EOFError is raised if the channel is closed
+        before any byte is read.
+        """
+        chunks = list()
+        (received, reported) = (0, 0)
+        while received < size:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not self.ready(remaining):
+                raise HandoffError("Timed out after receiving {} of {} "
+                                   "bytes".format(received, size))
+            chunk = self.sock.recv(min(size - received, 65536))
+            if not chunk:
+                if start and not received:
+                    raise EOFError("Handoff channel closed")
+                raise HandoffError("Handoff channel closed after "
+                                   "receiving {} of {} bytes"
+                                   .format(received, size))
+            chunks.append(chunk)
+            received += len(chunk)
+            if received - reported >= self.progress_size:
+                self.info("Received {} of {} bytes".format(received, size))
+                reported = received
+        return b"".join(chunks)
@@ -14,33 +14,56 @@
 from __future__ import print_function
 
 import multiprocessing
+import os
+import shutil
 import signal
+import threading
 import time
 
 import flask
 import gunicorn.app.base
+from werkzeug.http import is_resource_modified
 
 from rpki_agent.base import RpkiBase
 # from rpki_agent.vrp import VRP, VRPSet
 from rpki_agent.exceptions import handle_sigterm, TermException
+from rpki_agent.handoff import Handoff, HandoffError
+from rpki_agent.metrics import (exposition, metrics_name, read_metrics,
+                                RequestMetrics, Spans)
+from rpki_agent.render import object_commands, object_name, RenderedBody
+from rpki_agent.snapshot import MappedSnapshot
+from rpki_agent.store import BodyStore
 
 
 class RpkiListener(multiprocessing.Process, RpkiBase):
     """Listener to respond to requests for RPKI VRP config data."""
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, mode="fork", data_dir=None, worker_class="sync",
+                 workers=None, threads=None, *args, **kwargs):
         """Initialise an RpkiListener instance."""
         super(RpkiListener, self).__init__(*args, **kwargs)
         RpkiBase.__init__(self)
+        self.mode = mode
+        self.data_dir = data_dir
+        self.worker_class = worker_class
+        self.workers = workers
+        self.threads = threads
         self.p_err, self.c_err = multiprocessing.Pipe(duplex=False)
-        self.c_data, self.p_data = multiprocessing.Pipe(duplex=False)
+        self.p_data, self.c_data = Handoff.pair()
+        self.p_refresh, self.c_refresh = multiprocessing.Pipe(duplex=False)
 
     def run(self):
         """Run the listener process."""
         self.info("Listener started")
         signal.signal(signal.SIGTERM, handle_sigterm)
         try:
-            http_server = RpkiHttpServer(conn=self.c_data)
+            http_server = RpkiHttpServer(conn=self.c_data,
+                                         trigger=self.c_refresh,
+                                         mode=self.mode,
+                                         data_dir=self.data_dir,
+                                         worker_class=self.worker_class,
+                                         workers=self.workers,
+                                         threads=self.threads)
             http_server.run()
         except TermException:
             self.notice("Got SIGTERM signal: exiting.")
@@ -50,6 +73,7 @@ class RpkiListener(multiprocessing.Process, RpkiBase):
         finally:
             self.c_err.close()
             self.c_data.close()
+            self.c_refresh.close()
 
     @property
     def error(self):
@@ -59,83 +83,471 @@ class RpkiListener(multiprocessing.Process, RpkiBase):
 
 
 class RpkiHttpServer(gunicorn.app.base.BaseApplication, RpkiBase):
-    """An integrated webserver."""
+    """An integrated webserver.
 
-    app = flask.Flask(__name__)
+    The worker renders every config object once per cycle, and hands over
+    a processed Snapshot whose rendered bodies are served directly from a
+    memory-mapped BodyStore, and whose VRPSnapshot backs route origin
+    validation. Each request is served entirely from the MappedSnapshot
+    that was current when it arrived, and every response carries its
+    generation in an 'X-RPKI-Generation' header.
 
-    def __init__(self, conn, *args, **kwargs):
+    In 'fork' mode, Snapshot updates are received when the arbiter is sent
+    SIGHUP, and the MappedSnapshot is inherited by the re-forked workers.
+
+    In 'shared' mode, a watcher process, forked before the arbiter starts,
+    receives Snapshot updates as they arrive. Each one is published by
+    hard-linking its files into a directory of their own, then atomically
+    replacing the 'current' symlink to point at it. Every worker maps the
+    files of the directory that the symlink points to, and builds its own
+    RovIndex of them, in the background once it has been replaced, so
+    updates need no re-fork.
+    """
+
+    modes = ("fork", "shared")
+    stream_chunk_size = 64 * 1024
+    # gunicorn worker classes, mapped to the module that each one requires
+    worker_classes = {"sync": None, "gthread": "concurrent.futures",
+                      "gevent": "gevent", "eventlet": "eventlet"}
+    # the rule and methods of each route, served by the method named
+    # 'serve_<endpoint>'
+    routes = (("covered", "/prefix-lists/<afi>/covered", ["GET"]),
+              ("for_origin", "/prefix-lists/<afi>/origin/<origin>", ["GET"]),
+              ("policy", "/policy/<afi>", ["GET", "POST"]),
+              ("validate", "/validate", ["GET", "POST"]),
+              ("metrics", "/metrics", ["GET"]),
+              ("refresh", "/refresh", ["POST"]),
+              ("as_path", "/as-paths/<origin>", ["GET"]))
+
+    def __init__(self, conn, trigger=None, mode="fork", data_dir=None,
+                 worker_class="sync", workers=None, threads=None,
+                 *args, **kwargs):
         """Initialise an RpkiHttpServer instance."""
         RpkiBase.__init__(self)
+        if mode not in self.modes:
+            raise ValueError("Unknown listener mode '{}'".format(mode))
+        if mode == "shared" and data_dir is None:
+            raise ValueError("Listener mode 'shared' requires a data_dir")
+        if worker_class not in self.worker_classes:
+            raise ValueError("Unknown worker class '{}'".format(worker_class))
         self.conn = conn
-        self.vrps = None
-        self.origins = set()
-        self.covered = {"ipv4": [], "ipv6": []}
-        self.for_origin = {"ipv4": {}, "ipv6": {}}
+        self.trigger = trigger
+        self.mode = mode
+        self.worker_class = worker_class
+        self.workers = workers or multiprocessing.cpu_count() * 2
+        self.threads = threads or 1
+        self.data_dir = data_dir
+        if data_dir is not None:
+            self.current_path = os.path.join(data_dir, "current")
+        else:
+            self.current_path = None
+        self.mapped = None
+        # held while a newly published snapshot is mapped
+        self.mapping = threading.Lock()
+        self.requests = None
+        self.app = flask.Flask(__name__)
         super(RpkiHttpServer, self).__init__(*args, **kwargs)
-        self.cfg.set("workers", multiprocessing.cpu_count() * 2)
 
     def load(self):
         """Load WSGI application."""
         return self.app
 
     def load_config(self):
-        """Reload VRP data and process config objects."""
-        if self.get_vrps():
-            self.process_vrps()
+        """Set server options, then load the latest processed snapshot.
+
+        This is called on start-up and whenever the arbiter reloads, after
+        the configuration has been reset to the defaults.
+        """
+        self.cfg.set("worker_class", self.worker_class)
+        self.cfg.set("workers", self.workers)
+        self.cfg.set("threads", self.threads)
+        self.cfg.set("pre_fork",
+                     lambda arbiter, worker: self.assign_slot(arbiter, worker))
+        if self.mode == "shared":
+            # map the published snapshot before the worker serves requests
+            self.cfg.set("post_worker_init", lambda worker: self.current())
+        if self.mode == "fork":
+            snapshot = self.get_vrps()
+            if snapshot is not None:
+                self.info("Loading rendered data from {}"
+                          .format(snapshot.bodies))
+                spans = Spans()
+                with spans.span("listener_load"):
+                    self.mapped = MappedSnapshot(snapshot.vrps,
+                                                 snapshot.bodies)
+                self.conn.send_ack(snapshot.generation, **spans.stats)
+
+    def assign_slot(self, arbiter, worker):
+        """Assign a worker about to be forked a slot of the request metrics.
+
+        This is called in the arbiter, so the slot is inherited by the
+        worker, and no two live workers share one.
+        """
+        used = [getattr(w, "metrics_slot", None)
+                for w in arbiter.WORKERS.values()]
+        worker.metrics_slot = self.requests.slot = \
+            self.requests.free_slot(used)
+
+    def watch(self):
+        """Run the watcher process, until the pipe is closed."""
+        # exit quietly when terminated with the arbiter
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self.watch_vrps()
+
+    def watch_vrps(self):
+        """Receive and publish processed snapshots until the pipe is closed."""
+        self.info("Watching for VRP data from agent")
+        while True:
+            try:
+                self.conn.ready(timeout=None)
+                (kind, generation, snapshot) = self.conn.recv()
+            except (EOFError, IOError):
+                self.notice("VRP data channel closed")
+                return
+            except HandoffError as e:
+                # the channel cannot be resynchronised after a bad frame
+                self.err(e)
+                return
+            if kind != Handoff.snapshot:
+                continue
+            try:
+                self.info("Publishing rendered data from {}"
+                          .format(snapshot.bodies))
+                spans = Spans()
+                with spans.span("listener_load"):
+                    self.publish(snapshot)
+                self.conn.send_ack(generation, **spans.stats)
+            except Exception as e:
+                self.err(e)
+
+    def publish(self, snapshot):
+        """Publish a snapshot by atomically replacing the 'current' symlink.
+
+        Directories of previously published snapshots are then removed.
+        Workers keep serving from the files that they have already mapped.
+        """
+        name = "current-{}".format(snapshot.generation)
+        directory = os.path.join(self.data_dir, name)
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        os.mkdir(directory)
+        os.link(snapshot.vrps, os.path.join(directory, "vrps.bin"))
+        os.link(snapshot.bodies, os.path.join(directory, "bodies.bin"))
+        tmp_path = "{}.tmp".format(self.current_path)
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        os.symlink(name, tmp_path)
+        os.rename(tmp_path, self.current_path)
+        for entry in os.listdir(self.data_dir):
+            if entry.startswith("current-") and entry != name:
+                shutil.rmtree(os.path.join(self.data_dir, entry),
+                              ignore_errors=True)
+
+    def current(self):
+        """Get the current MappedSnapshot.
+
+        In 'shared' mode, a snapshot published since the current one was
+        mapped is mapped by a thread of its own, and the current one is
+        served until that has finished, so that no request waits for its
+        RovIndex to be built. Until a snapshot is first mapped there is
+        nothing to serve, so that one is mapped in place.
+        """
+        if self.mode == "fork":
+            return self.mapped
+        mapped = self.mapped
+        try:
+            directory = os.path.join(self.data_dir,
+                                     os.readlink(self.current_path))
+        except OSError:
+            # not yet published
+            return mapped
+        if mapped is None:
+            return self.map_published(directory)
+        if (mapped.store.path != os.path.join(directory, "bodies.bin") and
+                self.mapping.acquire(False)):
+            thread = threading.Thread(target=self.map_published,
+                                      args=(directory, self.mapping))
+            thread.daemon = True
+            thread.start()
+        return mapped
+
+    def map_published(self, directory, lock=None):
+        """Map the snapshot published in 'directory', and make it current.
+
+        'lock' is released once it is mapped, if given.
+        """
+        try:
+            # the previous snapshot is unmapped once no thread uses it
+            self.mapped = MappedSnapshot(os.path.join(directory, "vrps.bin"),
+                                         os.path.join(directory,
+                                                      "bodies.bin"))
+        except (IOError, OSError, ValueError):
+            # already replaced again
+            pass
+        finally:
+            if lock is not None:
+                lock.release()
+        return self.mapped
+
+    @staticmethod
+    def served():
+        """Get the MappedSnapshot that the current request is served from.
+
+        Aborts the request with a 404 if nothing is published yet.
+        """
+        mapped = flask.g.mapped
+        if mapped is None:
+            flask.abort(404)
+        return mapped
 
     def get_vrps(self):
-        """Receive VRP set from agent process."""
+        """Receive the latest processed snapshot from the agent process.
+
+        The agent sends a snapshot before signalling a reload, so only the
+        frames that are already ready are received, and all but the latest
+        snapshot are skipped.
+        """
         self.info("Trying to get new VRP data from agent")
-        for i in range(3):
-            time.sleep(1)
-            if self.conn.poll():
-                self.vrps = self.conn.recv()
-                self.info("Got data on try {}".format(i))
-                return True
-            self.info("Nothing to receive on try {}".format(i))
-        self.warning("No data received from agent")
-        return False
-
-    def process_vrps(self):
-        """Pre-process VRP set into EOS config syntax."""
-        self.origins = set()
-        for afi in ("ipv4", "ipv6"):
-            self.info("Creating prefix-lists for {} address-family"
-                      .format(afi))
-            self.covered[afi] = ["seq {seq} permit {prefix} le {maxLength}"
-                                 .format(seq=seq, **entry)
-                                 for seq, entry
-                                 in enumerate(self.vrps.covered(afi))]
-            origins = self.vrps.origins(afi)
-            self.for_origin[afi] = {}
-            for asn in origins:
-                self.for_origin[afi][asn] = ["seq {seq} permit {prefix} le {maxLength}"  # noqa: E501
-                                             .format(seq=seq, **entry)
-                                             for seq, entry
-                                             in enumerate(self.vrps.for_origin(asn, afi))]  # noqa: E501
-            self.origins.update(origins)
+        snapshot = None
+        try:
+            for (kind, generation, payload) in self.conn.frames():
+                if kind == Handoff.snapshot:
+                    self.info("Got VRP data for generation {}"
+                              .format(generation))
+                    snapshot = payload
+        except (EOFError, IOError, HandoffError) as e:
+            self.err("Receiving VRP data failed: {}".format(e))
+        if snapshot is None:
+            self.warning("No data received from agent")
+        return snapshot
 
-    def run(self, *args, **kwargs):
-        """Run the webserver."""
-        @self.app.route("/prefix-lists/<afi>/covered")
-        def covered(afi):
-            try:
-                return "\n".join(self.covered[afi])
-            except KeyError:
-                flask.abort(404)
+    def policy(self, store, afi, origins=None):
+        """Yield the per-origin config objects of an afi, in chunks.
 
-        @self.app.route("/prefix-lists/<afi>/origin/<origin>")
-        def for_origin(afi, origin):
-            try:
-                return "\n".join(self.for_origin[afi][origin])
-            except KeyError:
-                flask.abort(404)
+        Each origin's prefix-list is read from the BodyStore and followed
+        by its as-path access-list, in EOS configuration syntax. Lines are
+        collected into chunks of about 'stream_chunk_size' bytes. If
+        'origins' is None, every origin in the store is included,
+        otherwise origins without VRPs for 'afi' are skipped.
+        """
+        if origins is None:
+            origins = store.origins(afi)
+        (chunk, size) = (list(), 0)
+        for origin in origins:
+            body = store.get(afi, origin)
+            if body is None:
+                continue
+            name = object_name(afi, origin)
+            lines = ["{} {}".format(object_commands[afi], name)]
+            lines.extend("   {}".format(line) for line
+                         in body.data.decode("utf-8").splitlines())
+            lines.extend(["!", "{} {} permit _{}$ any"
+                          .format(object_commands["as-path"],
+                                  object_name(origin=origin), origin),
+                          "!", ""])
+            text = "\n".join(lines).encode("utf-8")
+            chunk.append(text)
+            size += len(text)
+            if size >= self.stream_chunk_size:
+                yield b"".join(chunk)
+                (chunk, size) = (list(), 0)
+        if chunk:
+            yield b"".join(chunk)
+
+    @staticmethod
+    def requested_origins():
+        """Get the origins requested in the query string or request body.
+
+        Origins may be given as repeated or comma separated 'origin'
+        arguments, or as a whitespace or comma separated list in the body
+        of a POST, with or without an 'AS' prefix. Returns a sorted list
+        of origins, or None if no origins were requested.
+        """
+        values = flask.request.args.getlist("origin")
+        if flask.request.method == "POST":
+            values.append(flask.request.get_data(as_text=True))
+        origins = set()
+        for value in values:
+            for origin in value.replace(",", " ").split():
+                if origin.upper().startswith("AS"):
+                    origin = origin[2:]
+                if not origin.isdigit():
+                    flask.abort(400)
+                origins.add(int(origin))
+        if not origins:
+            return None
+        return [str(asn) for asn in sorted(origins)]
+
+    def measure(self, resp, start):
+        """Record the response to the current request, started at 'start'.
+
+        A streamed body is measured as it is sent, and recorded once it
+        has been sent in full, or the client has gone away.
+        """
+        if self.requests is None:
+            return
+        rule = flask.request.url_rule
+        route = rule.endpoint if rule is not None else RequestMetrics.other
+        if resp.is_streamed:
+            resp.response = _measured(resp.response, self.requests, route,
+                                      resp.status_code, start)
+        else:
+            # cheaper than parsing the Content-Length header back
+            self.requests.record(route, resp.status_code,
+                                 sum(map(len, resp.response)),
+                                 time.time() - start)
+
+    @staticmethod
+    def respond(body):
+        """Create a (possibly conditional) response from a RenderedBody."""
+        if (body.gzipped is not None and
+                flask.request.accept_encodings["gzip"]):
+            resp = flask.Response(body.gzipped, mimetype="text/plain")
+            resp.headers["Content-Encoding"] = "gzip"
+            # strong entity-tags must differ between representations
+            resp.set_etag("{}-gz".format(body.etag))
+        else:
+            resp = flask.Response(body.data, mimetype="text/plain")
+            resp.set_etag(body.etag)
+        resp.headers["Vary"] = "Accept-Encoding"
+        if body.modified is not None:
+            resp.last_modified = body.modified
+        return resp.make_conditional(flask.request)
+
+    def pin(self):
+        """Pin the current MappedSnapshot for the duration of a request."""
+        g = flask.g._get_current_object()
+        g.start = time.time()
+        g.mapped = self.current()
+
+    def tag(self, resp):
+        """Tag a response with the generation it was served from."""
+        g = flask.g._get_current_object()
+        mapped = g.get("mapped")
+        if mapped is not None:
+            resp.headers["X-RPKI-Generation"] = str(mapped.generation)
+        self.measure(resp, g.get("start", time.time()))
+        return resp
+
+    def serve_covered(self, afi):
+        """Serve the covered prefix-list of an afi."""
+        body = self.served().store.get(afi)
+        if body is None:
+            flask.abort(404)
+        return self.respond(body)
+
+    def serve_for_origin(self, afi, origin):
+        """Serve the prefix-list of an origin."""
+        body = self.served().store.get(afi, origin)
+        if body is None:
+            flask.abort(404)
+        return self.respond(body)
 
-        @self.app.route("/as-paths/<origin>")
-        def as_path(origin):
-            if origin in self.origins:
-                return "permit _{}$ any\n".format(origin)
-            else:
-                flask.abort(404)
+    def serve_policy(self, afi):
+        """Stream the per-origin config objects of an afi."""
+        store = self.served().store
+        if afi not in BodyStore.afis:
+            flask.abort(404)
+        origins = self.requested_origins()
+        # make_conditional() would buffer the streamed body
+        if (flask.request.method == "GET" and
+                not is_resource_modified(flask.request.environ,
+                                         last_modified=store.modified)):
+            resp = flask.Response(status=304)
+        else:
+            resp = flask.Response(self.policy(store, afi, origins),
+                                  mimetype="text/plain")
+        resp.last_modified = store.modified
+        return resp
 
+    def serve_validate(self):
+        """Serve the route origin validation state of one or more routes."""
+        index = self.served().index
+        if flask.request.method == "GET":
+            routes = [flask.request.args]
+        else:
+            routes = flask.request.get_json(force=True, silent=True)
+            if isinstance(routes, dict):
+                routes = routes.get("routes")
+            if not isinstance(routes, list):
+                flask.abort(400)
+        try:
+            results = [{"prefix": route["prefix"], "origin": route["origin"],
+                        "state": index.validate(route["prefix"],
+                                                route["origin"])}
+                       for route in routes]
+        except (KeyError, TypeError, ValueError) as e:
+            return flask.Response("{}\n".format(e), status=400,
+                                  mimetype="text/plain")
+        if flask.request.method == "GET":
+            return flask.jsonify(generation=index.generation, **results[0])
+        return flask.jsonify(generation=index.generation, results=results)
+
+    def serve_metrics(self):
+        """Serve the agent and listener metrics."""
+        stats = dict()
+        if self.data_dir is not None:
+            stats.update(read_metrics(os.path.join(self.data_dir,
+                                                   metrics_name)))
+        if flask.g.mapped is not None:
+            stats["listener_serving_generation"] = flask.g.mapped.generation
+        text = exposition(stats)
+        if self.requests is not None:
+            text += self.requests.exposition()
+        return flask.Response(text, mimetype="text/plain; version=0.0.4")
+
+    def serve_refresh(self):
+        """Trigger a refresh cycle of the agent."""
+        if self.trigger is None:
+            flask.abort(404)
+        self.trigger.send("listener request from {}"
+                          .format(flask.request.remote_addr))
+        return flask.Response("refresh triggered\n", status=202,
+                              mimetype="text/plain")
+
+    def serve_as_path(self, origin):
+        """Serve the as-path access-list of an origin."""
+        store = self.served().store
+        if not any(store.find(afi, origin) is not None
+                   for afi in BodyStore.afis):
+            flask.abort(404)
+        return self.respond(RenderedBody(["permit _{}$ any".format(origin),
+                                          ""], modified=store.modified))
+
+    def register(self):
+        """Register the request hooks and routes with the application.
+
+        The request metrics are allocated here, before the workers are
+        forked, so that they are shared by every worker. While workers are
+        replaced on a reload, there are up to twice as many of them.
+        """
+        self.app.before_request(self.pin)
+        self.app.after_request(self.tag)
+        for endpoint, rule, methods in self.routes:
+            self.app.add_url_rule(rule, endpoint,
+                                  getattr(self, "serve_{}".format(endpoint)),
+                                  methods=methods)
+        self.requests = RequestMetrics(self.app.view_functions,
+                                       slots=self.workers * 2)
+
+    def run(self, *args, **kwargs):
+        """Run the webserver."""
+        self.register()
+        if self.mode == "shared":
+            # a process rather than a thread, so that the arbiter has no
+            # other thread that could hold a lock when it forks a worker
+            watcher = multiprocessing.Process(target=self.watch)
+            watcher.daemon = True
+            watcher.start()
         super(RpkiHttpServer, self).run(*args, **kwargs)
+
+
+def _measured(chunks, requests, route, status, start):
+    """Record a streamed response once its chunks have passed through."""
+    sent = 0
+    try:
+        for chunk in chunks:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        requests.record(route, status, sent, time.time() - start)
@@ -0,0 +1,234 @@
+# Copyright (c) 2019 Ben Maddison. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""rpki_agent metrics."""
+
+from __future__ import print_function
+
+import bisect
+import contextlib
+import ctypes
+import json
+import multiprocessing
+import multiprocessing.sharedctypes
+import numbers
+import os
+import re
+import resource
+import threading
+import time
+
+# the name of the file in the agent data directory holding reported stats
+metrics_name = "metrics.json"
+
+
+class Spans(object):
+    """Timing and peak memory of the stages of a pipeline.
+
+    The duration of each stage timed with span() is recorded in 'stats' as
+    'stage_<name>_ms', and the peak resident set size of the process during
+    the stage as 'stage_<name>_peak_kb'. The peak is reset at the start of
+    each stage where the kernel allows it, otherwise it is the peak of the
+    process so far. Stages must not be nested.
+    """
+
+    def __init__(self):
+        """Initialise a Spans instance."""
+        self.stats = dict()
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """Time a stage of the pipeline."""
+        reset_peak_rss()
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.stats["stage_{}_ms".format(name)] = \
+                int((time.time() - start) * 1000)
+            self.stats["stage_{}_peak_kb".format(name)] = peak_rss()
+
+
+class RequestMetrics(object):
+    """Per-route request counters and latency histograms.
+
+    The counters of each route are: the number of responses in each
+    status class, the total response body size, the total latency, and
+    the number of responses in each latency bucket. They are kept in a
+    shared memory array, allocated before the gunicorn workers are forked,
+    with one slot of counters for each worker, so that every worker reports
+    the totals of all of them.
+
+    Each worker only adds to its own slot, so no lock is shared between
+    workers, and a worker killed while recording a response cannot block
+    the others. The slot of a worker that has exited is assigned to the
+    next one forked, which adds to its totals. A scrape may see a response
+    that is only partly recorded.
+    """
+
+    classes = ("2xx", "3xx", "4xx", "5xx")
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1.0, 2.5, 5.0, 10.0)
+    other = "other"
+
+    def __init__(self, routes, slots=1):
+        """Allocate 'slots' slots of counters for a list of route names.
+
+        Requests for any other route are counted under 'other'.
+        """
+        self.routes = sorted(set(routes) | {self.other})
+        self.index = {route: i for i, route in enumerate(self.routes)}
+        # status classes, bytes, latency in microseconds, then buckets
+        # (including +Inf)
+        self.offset = len(self.classes) + 2
+        self.width = self.offset + len(self.buckets) + 1
+        self.slots = slots
+        self.size = len(self.routes) * self.width
+        self.counters = multiprocessing.sharedctypes.RawArray(
+            ctypes.c_uint64, slots * self.size)
+        # the slot of this process, set before each worker is forked
+        self.slot = 0
+        # serialises the threads of one process only
+        self.lock = threading.Lock()
+
+    def free_slot(self, used):
+        """Get a slot that is not in 'used', the slots of live workers.
+
+        If there is none, a slot is shared, and some of the responses
+        recorded in it may be lost.
+        """
+        used = set(used)
+        for slot in range(self.slots):
+            if slot not in used:
+                return slot
+        return len(used) % self.slots
+
+    def record(self, route, status, size, elapsed):
+        """Record a response to a route, taking 'elapsed' seconds."""
+        base = (self.slot * self.size +
+                self.index.get(route, self.index[self.other]) * self.width)
+        status_class = min(max(status // 100, 2), 5) - 2
+        bucket = bisect.bisect_left(self.buckets, elapsed)
+        counters = self.counters
+        with self.lock:
+            counters[base + status_class] += 1
+            counters[base + len(self.classes)] += size
+            counters[base + len(self.classes) + 1] += int(elapsed * 1e6)
+            counters[base + self.offset + bucket] += 1
+
+    def exposition(self, prefix="rpki_agent"):
+        """Render the counters in the Prometheus text exposition format."""
+        counters = self.counters[:]
+        counters = [sum(counters[i::self.size]) for i in range(self.size)]
+        (requests, size, latency) = (list(), list(), list())
+        for route in self.routes:
+            row = counters[self.index[route] * self.width:
+                           (self.index[route] + 1) * self.width]
+            label = 'route="{}"'.format(route)
+            for status_class, count in zip(self.classes, row):
+                requests.append('{}_http_requests_total{{{},code="{}"}} {}'
+                                .format(prefix, label, status_class, count))
+            size.append("{}_http_response_bytes_total{{{}}} {}"
+                        .format(prefix, label, row[len(self.classes)]))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",),
+                                    row[self.offset:]):
+                cumulative += count
+                latency.append('{}_http_request_duration_seconds_bucket'
+                               '{{{},le="{}"}} {}'
+                               .format(prefix, label, bound, cumulative))
+            latency.append("{}_http_request_duration_seconds_sum{{{}}} {}"
+                           .format(prefix, label,
+                                   row[len(self.classes) + 1] / 1e6))
+            latency.append("{}_http_request_duration_seconds_count{{{}}} {}"
+                           .format(prefix, label, cumulative))
+        lines = ["# TYPE {}_http_requests_total counter".format(prefix)]
+        lines.extend(requests)
+        lines.append("# TYPE {}_http_response_bytes_total counter"
+                     .format(prefix))
+        lines.extend(size)
+        lines.append("# TYPE {}_http_request_duration_seconds histogram"
+                     .format(prefix))
+        lines.extend(latency)
+        lines.append("")
+        return "\n".join(lines)
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size of the process, if supported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except (IOError, OSError):
+        pass
+
+
+def peak_rss():
+    """Get the peak resident set size of the process, in KiB."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def write_metrics(path, stats):
+    """Atomically write a dict of reported stats to 'path'."""
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, "w") as f:
+        json.dump(stats, f, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def read_metrics(path):
+    """Read the stats written by write_metrics(), or an empty dict."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return dict()
+
+
+def exposition(stats, prefix="rpki_agent"):
+    """Render numeric stats in the Prometheus text exposition format.
+
+    Stage spans become the 'stage_duration_seconds' and
+    'stage_peak_rss_bytes' gauges, labelled by stage. Every other numeric
+    stat becomes a gauge of its own name, and non-numeric stats are left
+    out.
+    """
+    stage = re.compile(r"^stage_(\w+)_(ms|peak_kb)$")
+    families = dict()
+    for name, value in stats.items():
+        if (not isinstance(value, numbers.Number) or
+                isinstance(value, bool)):
+            continue
+        match = stage.match(name)
+        if match is None:
+            metric = re.sub(r"\W", "_", name)
+            families.setdefault(metric, []).append(("", value))
+        elif match.group(2) == "ms":
+            families.setdefault("stage_duration_seconds", []).append(
+                ('{{stage="{}"}}'.format(match.group(1)), value / 1000.0))
+        else:
+            families.setdefault("stage_peak_rss_bytes", []).append(
+                ('{{stage="{}"}}'.format(match.group(1)), value * 1024))
+    lines = list()
+    for metric in sorted(families):
+        name = "{}_{}".format(prefix, metric)
+        lines.append("# TYPE {} gauge".format(name))
+        for labels, value in sorted(families[metric]):
+            lines.append("{}{} {}".format(name, labels, value))
+    lines.append("")
+    return "\n".join(lines)
@@ -0,0 +1,173 @@
+# Copyright (c) 2019 Ben Maddison. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""rpki_agent eAPI configuration push."""
+
+from __future__ import print_function
+
+import json
+import os
+import time
+
+from rpki_agent.base import RpkiBase
+from rpki_agent.render import object_commands, object_name
+from rpki_agent.store import BodyStore
+
+
+class EapiPush(RpkiBase):
+    """Push rendered config objects to the local switch over eAPI.
+
+    Prefix-lists are named '<prefix>-COVERED-V4' or '<prefix>-AS<n>-V6',
+    and as-path access-lists '<prefix>-AS<n>'. The entity-tag of every
+    object last pushed is recorded in a state file, so that only objects
+    whose content has changed are sent again.
+
+    All changes are made in a single configuration session, sent in
+    batches of at most 'batch_size' commands, and committed atomically.
+    """
+
+    prefix = "RPKI"
+    batch_size = 1000
+    state_name = "pushed.json"
+    commands = object_commands
+
+    def __init__(self, node, data_dir):
+        """Initialise an EapiPush instance."""
+        RpkiBase.__init__(self)
+        self.node = node
+        self.state_path = os.path.join(data_dir, self.state_name)
+        self.batches = 0
+
+    def load_state(self):
+        """Load the record of the objects last pushed."""
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {"generation": None, "objects": {}}
+
+    def save_state(self, generation, objects):
+        """Atomically save the record of the objects pushed."""
+        tmp_path = "{}.tmp".format(self.state_path)
+        with open(tmp_path, "w") as f:
+            json.dump({"generation": generation, "objects": objects}, f)
+        os.rename(tmp_path, self.state_path)
+
+    def objects(self, store):
+        """Get the objects to configure, as {name: (kind, origin, etag)}."""
+        objects = dict()
+        for afi, origin, etag in store.entries():
+            if origin is not None:
+                objects[object_name(origin=origin, prefix=self.prefix)] = \
+                    ("as-path", origin, "as-path")
+            objects[object_name(afi, origin, self.prefix)] = \
+                (afi, origin, etag)
+        return objects
+
+    def push(self, snapshot):
+        """Push the config objects of a processed snapshot.
+
+        Returns a dict of statistics.
+        """
+        start = time.time()
+        self.batches = 0
+        state = self.load_state()
+        if state["generation"] == snapshot.generation:
+            return {"eapi_push_result": "unchanged"}
+        with BodyStore(snapshot.bodies) as store:
+            objects = self.objects(store)
+            pushed = state["objects"]
+            changed = sorted(name for name, (_, _, etag) in objects.items()
+                             if pushed.get(name) != etag)
+            removed = sorted(set(pushed) - set(objects))
+            if changed or removed:
+                session = "rpki-agent-{}".format(snapshot.generation)
+                self.info("Pushing {} changed and {} removed objects in "
+                          "configuration session {}"
+                          .format(len(changed), len(removed), session))
+                self.commit(session, self.groups(store, objects,
+                                                 changed, removed))
+        self.save_state(snapshot.generation,
+                        {name: etag for name, (_, _, etag) in objects.items()})
+        return {"eapi_push_result": "ok",
+                "eapi_objects_changed": len(changed),
+                "eapi_objects_removed": len(removed),
+                "eapi_batches": self.batches,
+                "eapi_push_ms": int((time.time() - start) * 1000)}
+
+    def groups(self, store, objects, changed, removed):
+        """Yield the commands to apply, as (mode, commands) groups.
+
+        'mode' is the command that enters the configuration mode in which
+        'commands' must be run, or None for the top level.
+        """
+        suffixes = {"-V4": "ipv4", "-V6": "ipv6"}
+        for name in removed:
+            kind = suffixes.get(name[-3:], "as-path")
+            yield (None, ["no {} {}".format(self.commands[kind], name)])
+        for name in changed:
+            (kind, origin, _) = objects[name]
+            command = "{} {}".format(self.commands[kind], name)
+            yield (None, ["no {}".format(command)])
+            if kind == "as-path":
+                yield (None, ["{} permit _{}$ any".format(command, origin)])
+                continue
+            lines = store.get(kind, origin).data.decode("utf-8").splitlines()
+            if lines:
+                yield (command, lines)
+            else:
+                yield (None, [command, "exit"])
+
+    def commit(self, session, groups):
+        """Run command groups in batches in a session, then commit it.
+
+        If any batch fails, the session is aborted.
+        """
+        enter = "configure session {}".format(session)
+        try:
+            for batch in self.batched(enter, groups):
+                self.run(batch)
+        except Exception:
+            self.warning("Aborting configuration session {}".format(session))
+            try:
+                self.run([enter, "abort"])
+            except Exception as e:
+                self.err(e)
+            raise
+
+    def batched(self, enter, groups):
+        """Yield the commands of 'groups' in batches of up to 'batch_size'.
+
+        Each batch starts with the 'enter' command that enters the session,
+        and the last one ends with the commit.
+        """
+        (batch, mode) = ([enter], None)
+        for group_mode, commands in groups:
+            for command in commands:
+                if group_mode != mode:
+                    if mode is not None:
+                        batch.append("exit")
+                    if group_mode is not None:
+                        batch.append(group_mode)
+                    mode = group_mode
+                batch.append(command)
+                if len(batch) >= self.batch_size:
+                    yield batch
+                    (batch, mode) = ([enter], None)
+        if mode is not None:
+            batch.append("exit")
+        batch.append("commit")
+        yield batch
+
+    def run(self, batch):
+        """Run a batch of commands in a single eAPI request."""
+        self.batches += 1
+        self.node.run_commands(batch)
@@ -0,0 +1,83 @@
+# Copyright (c) 2019 Ben Maddison. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""rpki_agent config object rendering."""
+
+from __future__ import print_function
+
+import hashlib
+import operator
+import zlib
+
+
+def prefix_list_lines(entries):
+    """Render VRPs as EOS prefix-list lines.
+
+    Entries are sorted first, so that the same set of VRPs always renders
+    to the same body, and therefore the same entity-tag.
+    """
+    entries = sorted(entries, key=operator.attrgetter("key"))
+    return ["seq {seq} permit {prefix} le {maxLength}"
+            .format(seq=seq, **entry)
+            for seq, entry in enumerate(entries)]
+
+
+# configuration commands that create each kind of config object
+object_commands = {"ipv4": "ip prefix-list", "ipv6": "ipv6 prefix-list",
+                   "as-path": "ip as-path access-list"}
+
+
+def object_name(afi=None, origin=None, prefix="RPKI"):
+    """Get the name of a config object.
+
+    Prefix-lists are named '<prefix>-COVERED-V4' or '<prefix>-AS<n>-V6',
+    and the as-path access-list of an origin, for which 'afi' is None,
+    '<prefix>-AS<n>'.
+    """
+    if afi is None:
+        return "{}-AS{}".format(prefix, origin)
+    if origin is None:
+        return "{}-COVERED-{}".format(prefix, afi[-2:].upper())
+    return "{}-AS{}-{}".format(prefix, origin, afi[-2:].upper())
+
+
+class RenderedBody(object):
+    """A fully rendered and encoded HTTP response body.
+
+    Bodies of at least 'compress_min' bytes are also gzip compressed once,
+    when rendered, so that they can be served to clients that accept the
+    gzip content-coding without any per-request work.
+
+    Each body carries a strong entity-tag derived from its content, and the
+    time at which it was last modified.
+    """
+
+    __slots__ = ("data", "gzipped", "etag", "modified")
+
+    compress_min = 1024
+    compress_level = 6
+
+    def __init__(self, lines, modified=None):
+        """Render a list of lines into a RenderedBody."""
+        self.data = "\n".join(lines).encode("utf-8")
+        self.etag = hashlib.sha1(self.data).hexdigest()
+        self.modified = modified
+        if len(self.data) >= self.compress_min:
+            # wbits of 16 + MAX_WBITS selects the gzip container format
+            compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            self.gzipped = compressor.compress(self.data) + compressor.flush()
+        else:
+            self.gzipped = None
+
+    def __len__(self):
+        """Get the length of the uncompressed body."""
+        return len(self.data)
@@ -0,0 +1,118 @@
+# Copyright (c) 2019 Ben Maddison. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""rpki_agent route origin validation."""
+
+from __future__ import print_function
+
+import binascii
+import socket
+
+
+class RovIndex(object):
+    """A longest-prefix-match index of a VRP set, for origin validation.
+
+    VRPs are indexed per address-family in one dict per prefix length,
+    keyed by the network bits of the VRP prefix, so that the VRPs covering
+    a route are found with one dict lookup for each prefix length present
+    in the set, up to the length of the route.
+
+    Routes are validated as described in RFC 6811, section 2.
+    """
+
+    valid, invalid, not_found = "valid", "invalid", "not-found"
+    widths = {4: 32, 6: 128}
+    families = {4: socket.AF_INET, 6: socket.AF_INET6}
+
+    def __init__(self, records, generation=None):
+        """Build an index from (asn, afi, addr, length, maxLength) records.
+
+        Any further fields in each record are ignored.
+        """
+        self.generation = generation
+        self.count = 0
+        tables = {afi: dict() for afi in self.widths}
+        for record in records:
+            (asn, afi, addr, length, max_length) = record[:5]
+            bits = int(binascii.hexlify(addr), 16) >> (self.widths[afi] -
+                                                       length)
+            table = tables[afi].setdefault(length, dict())
+            table.setdefault(bits, []).append((max_length, asn))
+            self.count += 1
+        # (length, shift, table) for each indexed length, in ascending order
+        self.tables = {afi: [(length, self.widths[afi] - length,
+                              lengths[length])
+                             for length in sorted(lengths)]
+                       for afi, lengths in tables.items()}
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """Build an index from the records of a mapped VRPSnapshot."""
+        return cls(snapshot.records(), snapshot.generation)
+
+    @classmethod
+    def parse_prefix(cls, prefix):
+        """Parse a route prefix into an (afi, address, length) tuple.
+
+        Raises ValueError if 'prefix' is not a valid prefix in CIDR
+        notation. Any host bits set in the address are ignored.
+        """
+        try:
+            (address, length) = prefix.split("/")
+            afi = 6 if ":" in address else 4
+            address = int(binascii.hexlify(
+                socket.inet_pton(cls.families[afi], address)), 16)
+            length = int(length)
+        except (AttributeError, socket.error, TypeError, ValueError):
+            raise ValueError("Invalid prefix '{}'".format(prefix))
+        if not 0 <= length <= cls.widths[afi]:
+            raise ValueError("Invalid prefix length in '{}'".format(prefix))
+        return (afi, address, length)
+
+    @staticmethod
+    def parse_origin(origin):
+        """Parse an origin AS, with or without an 'AS' prefix.
+
+        Raises ValueError if 'origin' is not a valid AS number.
+        """
+        text = str(origin).upper()
+        if text.startswith("AS"):
+            text = text[2:]
+        try:
+            number = int(text)
+        except ValueError:
+            raise ValueError("Invalid origin '{}'".format(origin))
+        if not 0 <= number < 2 ** 32:
+            raise ValueError("Invalid origin '{}'".format(origin))
+        return number
+
+    def validate(self, prefix, origin):
+        """Get the validation state of a route, given its prefix and origin.
+
+        Returns 'valid' if a VRP covering the route matches its origin and
+        length, 'invalid' if VRPs cover the route but none match, and
+        'not-found' if no VRP covers it. A VRP with an origin of AS0 never
+        matches.
+        """
+        (afi, address, route_length) = self.parse_prefix(prefix)
+        origin = self.parse_origin(origin)
+        covered = False
+        for (length, shift, table) in self.tables[afi]:
+            if length > route_length:
+                break
+            entries = table.get(address >> shift)
+            if entries is None:
+                continue
+            covered = True
+            for (max_length, asn) in entries:
+                if asn == origin and asn != 0 and route_length <= max_length:
+                    return self.valid
+        return self.invalid if covered else self.not_found
@@ -0,0 +1,336 @@
+# Copyright (c) 2019 Ben Maddison. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""rpki_agent RPKI to Router protocol client."""
+
+from __future__ import print_function
+
+import itertools
+import select
+import signal
+import socket
+import struct
+import time
+
+from requests.compat import urlparse
+
+from rpki_agent.base import RpkiBase
+from rpki_agent.exceptions import handle_sigterm, TermException
+from rpki_agent.metrics import Spans
+from rpki_agent.vrp import VRP, VRPSet
+from rpki_agent.worker import RpkiWorker
+
+
+class RtrError(Exception):
+    """Raised on an RPKI to Router protocol error."""
+
+    def __init__(self, msg, code=None):
+        """Initialise an RtrError instance."""
+        super(RtrError, self).__init__(msg)
+        self.code = code
+
+
+class RtrClient(RpkiBase):
+    """An RPKI to Router protocol (RFC 8210) client session.
+
+    The client holds the current VRP set of the cache in 'vrps', along with
+    the session ID and serial number it corresponds to, and applies the
+    incremental updates received in response to each Serial Query.
+    Version 1 of the protocol is tried first, falling back to version 0
+    (RFC 6810) if the cache does not support it.
+    """
+
+    versions = (1, 0)
+    header = struct.Struct("!BBHI")
+    serial_pdu = struct.Struct("!I")
+    end_of_data = struct.Struct("!IIII")
+    prefix = {4: struct.Struct("!BBBx4sI"), 6: struct.Struct("!BBBx16sI")}
+    (serial_notify, serial_query, reset_query, cache_response,
+     ipv4_prefix, ipv6_prefix, end_of_data_pdu, cache_reset,
+     router_key, error_report) = (0, 1, 2, 3, 4, 6, 7, 8, 9, 10)
+    unsupported_version = 4
+    # the method handling each PDU type within a cache response
+    handlers = {serial_notify: "on_serial_notify",
+                cache_response: "on_cache_response",
+                ipv4_prefix: "on_prefix", ipv6_prefix: "on_prefix",
+                router_key: "on_router_key", cache_reset: "on_cache_reset",
+                error_report: "on_error_report",
+                end_of_data_pdu: "on_end_of_data"}
+    max_pdu_length = 64 * 1024
+    timeout = 30
+
+    def __init__(self, host, port=323):
+        """Initialise an RtrClient instance."""
+        RpkiBase.__init__(self)
+        self.host = host
+        self.port = port
+        self.version = self.versions[0]
+        self.sock = None
+        self.session_id = None
+        self.serial = None
+        # default timing parameters from RFC 8210, section 6
+        self.refresh = 3600
+        self.retry = 600
+        self.expire = 7200
+        self.notified = False
+        self.vrps = VRPSet([])
+
+    def connect(self):
+        """Open the transport connection to the cache."""
+        self.info("Connecting to RTR cache {}:{}".format(self.host, self.port))
+        self.sock = socket.create_connection((self.host, self.port),
+                                             timeout=self.timeout)
+
+    def close(self):
+        """Close the transport connection to the cache."""
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def start(self):
+        """Connect and load the full VRP set, negotiating the version.
+
+        Returns the (added, removed) VRPSets relative to the VRP set held
+        before.
+        """
+        for version in self.versions:
+            self.version = version
+            self.connect()
+            try:
+                return self.reset()
+            except RtrError as e:
+                if (e.code != self.unsupported_version or
+                        version == self.versions[-1]):
+                    raise
+                self.notice("Cache does not support RTR version {}"
+                            .format(version))
+                self.close()
+
+    def reset(self):
+        """Send a Reset Query and load the full VRP set."""
+        self.info("Sending Reset Query")
+        # a Serial Notify received so far is answered by this query, but
+        # one received during the response is still pending
+        self.notified = False
+        self.send(self.reset_query)
+        return self.response(reset=True)
+
+    def update(self):
+        """Send a Serial Query and apply the incremental update."""
+        self.info("Sending Serial Query for serial {}".format(self.serial))
+        self.notified = False
+        self.send(self.serial_query, self.session_id,
+                  self.serial_pdu.pack(self.serial))
+        return self.response()
+
+    def wait(self, timeout):
+        """Wait up to 'timeout' seconds for a Serial Notify from the cache.
+
+        Returns True if the cache has notified that new data is available.
+        """
+        deadline = time.time() + timeout
+        while not self.notified:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            (readable, _, _) = select.select([self.sock], [], [], remaining)
+            if not readable:
+                return False
+            (kind, field, body) = self.recv()
+            if kind == self.serial_notify:
+                self.notified = True
+            elif kind == self.error_report:
+                raise self.error(field, body)
+            else:
+                raise RtrError("Unexpected PDU type {} outside of a response"
+                               .format(kind))
+        return True
+
+    def send(self, kind, field=0, body=b""):
+        """Send a PDU to the cache."""
+        self.sock.sendall(self.header.pack(self.version, kind, field,
+                                           self.header.size + len(body)) +
+                          body)
+
+    def recv(self):
+        """Receive a PDU from the cache, as a (type, field, body) tuple."""
+        (version, kind, field, length) = \
+            self.header.unpack(self._read(self.header.size))
+        if not self.header.size <= length <= self.max_pdu_length:
+            raise RtrError("Invalid PDU length {}".format(length))
+        body = self._read(length - self.header.size)
+        if kind == self.error_report:
+            return (kind, field, body)
+        if version != self.version:
+            raise RtrError("Unexpected RTR version {} in PDU type {}"
+                           .format(version, kind),
+                           code=self.unsupported_version)
+        return (kind, field, body)
+
+    def _read(self, size):
+        """Read exactly 'size' bytes from the cache."""
+        data = b""
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise RtrError("Connection closed by cache")
+            data += chunk
+        return data
+
+    def error(self, code, body):
+        """Create an RtrError from the body of an Error Report PDU."""
+        (pdu_len,) = self.serial_pdu.unpack_from(body, 0)
+        offset = self.serial_pdu.size + pdu_len
+        (text_len,) = self.serial_pdu.unpack_from(body, offset)
+        offset += self.serial_pdu.size
+        text = body[offset:offset + text_len].decode("utf-8", "replace")
+        return RtrError("Error Report from cache: code {}: {}"
+                        .format(code, text), code=code)
+
+    def response(self, reset=False):
+        """Receive a cache response, and apply it at End of Data.
+
+        Each PDU is passed to its handler in 'handlers', until one returns
+        the (added, removed) VRPSets relative to the VRP set held before.
+        """
+        changes = (list(), list())
+        while True:
+            (kind, field, body) = self.recv()
+            try:
+                handler = getattr(self, self.handlers[kind])
+            except KeyError:
+                raise RtrError("Unexpected PDU type {}".format(kind))
+            result = handler(kind, field, body, changes, reset)
+            if result is not None:
+                return result
+
+    def on_serial_notify(self, kind, field, body, changes, reset):
+        """Note that the cache has new data after this response."""
+        self.notified = True
+
+    def on_cache_response(self, kind, field, body, changes, reset):
+        """Check the session ID of the response."""
+        if not reset and field != self.session_id:
+            raise RtrError("Session ID changed from {} to {}"
+                           .format(self.session_id, field))
+        self.session_id = field
+
+    def on_prefix(self, kind, field, body, changes, reset):
+        """Add an announced or withdrawn VRP to the changes."""
+        afi = 4 if kind == self.ipv4_prefix else 6
+        (flags, length, max_length, addr, asn) = self.prefix[afi].unpack(body)
+        vrp = VRP.from_fields(asn, afi, addr, length, max_length)
+        changes[0 if flags & 1 else 1].append(vrp)
+
+    def on_router_key(self, kind, field, body, changes, reset):
+        """Ignore a Router Key."""
+
+    def on_cache_reset(self, kind, field, body, changes, reset):
+        """Reload the full VRP set."""
+        self.info("Got Cache Reset")
+        return self.reset()
+
+    def on_error_report(self, kind, field, body, changes, reset):
+        """Raise the error reported by the cache."""
+        raise self.error(field, body)
+
+    def on_end_of_data(self, kind, field, body, changes, reset):
+        """Apply the changes of the response."""
+        self.end(body)
+        return self.apply(changes[0], changes[1], reset)
+
+    def end(self, body):
+        """Process the body of an End of Data PDU."""
+        if self.version == 0:
+            (self.serial,) = self.serial_pdu.unpack(body)
+        else:
+            (self.serial, self.refresh,
+             self.retry, self.expire) = self.end_of_data.unpack(body)
+        self.info("Got End of Data for serial {}".format(self.serial))
+
+    def apply(self, announced, withdrawn, reset=False):
+        """Apply announced and withdrawn VRPs to the VRP set."""
+        if reset:
+            vrps = VRPSet(announced)
+            (added, removed) = vrps.diff(self.vrps)
+            self.vrps = vrps
+        else:
+            added = VRPSet(vrp for vrp in announced if vrp not in self.vrps)
+            removed = VRPSet(vrp for vrp in withdrawn if vrp in self.vrps)
+            self.vrps.update(added, removed)
+        self.info("Applied {} announced and {} withdrawn VRPs"
+                  .format(len(added), len(removed)))
+        return (added, removed)
+
+
+class RtrWorker(RpkiWorker):
+    """Worker that follows the VRP set of a cache over RTR.
+
+    Unlike an RpkiWorker, an RtrWorker is long lived. It keeps an RTR
+    session open to the first reachable cache in 'cache_urls', given as
+    'rtr://host[:port]', and sends the agent a processed snapshot each
+    time the serial of the cache changes.
+    """
+
+    persistent = True
+    follows = True
+    retry = 30
+
+    def run(self):
+        """Run the worker process."""
+        self.info("RTR worker started")
+        signal.signal(signal.SIGTERM, handle_sigterm)
+        try:
+            self.node = self.connect_eapi()
+            for url in itertools.cycle(self.cache_urls):
+                try:
+                    self.follow(url)
+                except (socket.error, struct.error, RtrError) as e:
+                    self.warning("RTR session with {} failed: {}"
+                                 .format(url, e))
+                time.sleep(self.retry)
+        except TermException:
+            self.notice("Got SIGTERM signal: exiting.")
+        except Exception as e:
+            self.report_error(e)
+        finally:
+            self.c_err.close()
+            self.c_data.close()
+
+    def follow(self, url):
+        """Follow the VRP set of a cache until the session fails."""
+        parsed = urlparse(url)
+        client = RtrClient(parsed.hostname, parsed.port or 323)
+        try:
+            client.start()
+            self.publish(url, client)
+            while True:
+                client.wait(client.refresh)
+                serial = client.serial
+                delta = client.update()
+                if client.serial != serial:
+                    self.publish(url, client, delta=delta)
+        finally:
+            client.close()
+
+    def publish(self, url, client, delta=None):
+        """Process the VRP set of the cache and send it to the agent."""
+        self.validators = {"url": url, "session_id": client.session_id,
+                           "serial": client.serial}
+        self.spans = Spans()
+        (stats, snapshot) = self.process(client.vrps, delta=delta)
+        stats.update(self.spans.stats)
+        stats.update(rtr_cache=url, rtr_session_id=client.session_id,
+                     rtr_serial=client.serial)
+        if snapshot is not None:
+            self.previous = snapshot
+        self.deliver(self.previous, stats)
+        self.c_data.send((stats, snapshot, self.validators))
@@ -0,0 +1,227 @@
+# Copyright (c) 2019 Ben Maddison. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""rpki_agent binary VRP snapshots."""
+
+from __future__ import print_function
+
+import collections
+import mmap
+import os
+import shutil
+import struct
+
+from rpki_agent.rov import RovIndex
+from rpki_agent.store import BodyStore
+from rpki_agent.vrp import VRP, VRPSet
+
+
+class Snapshot(collections.namedtuple("Snapshot",
+                                      ("generation", "vrps", "bodies"))):
+    """The files making up one processed snapshot.
+
+    'vrps' is the path of a VRPSnapshot of the VRP set, and 'bodies' the
+    path of a BodyStore of the config objects rendered from it.
+    """
+
+    __slots__ = ()
+    names = {"vrps": "vrps.bin", "bodies": "bodies.bin"}
+
+    def persist(self, directory):
+        """Durably copy the snapshot files into 'directory'.
+
+        Each file is written to a temporary name, synced and renamed into
+        place. A crash between the two renames leaves files of different
+        generations, which restore() rejects.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for field, name in sorted(self.names.items()):
+            _copy(getattr(self, field), os.path.join(directory, name),
+                  sync=True)
+        return Snapshot(self.generation,
+                        **{field: os.path.join(directory, name)
+                           for field, name in self.names.items()})
+
+    @classmethod
+    def restore(cls, directory, data_dir):
+        """Copy a snapshot persisted in 'directory' into 'data_dir'.
+
+        Returns the restored Snapshot, or None if nothing is persisted.
+        Raises ValueError if the persisted files are not a valid, matching
+        pair.
+        """
+        paths = {field: os.path.join(directory, name)
+                 for field, name in cls.names.items()}
+        if not all(os.path.isfile(path) for path in paths.values()):
+            return None
+        with VRPSnapshot(paths["vrps"]) as vrps:
+            generation = vrps.generation
+        with BodyStore(paths["bodies"]) as bodies:
+            if bodies.generation != generation:
+                raise ValueError("Persisted snapshot files in {} are from "
+                                 "different generations".format(directory))
+        snapshot = cls(generation,
+                       **{field: os.path.join(data_dir, "{}-{}.bin"
+                                              .format(field, generation))
+                          for field in cls.names})
+        for field in sorted(cls.names):
+            _copy(paths[field], getattr(snapshot, field))
+        return snapshot
+
+
+class MappedSnapshot(object):
+    """The mapped files of one processed snapshot, served as a unit.
+
+    Both files are mapped, and checked to be of the same generation, before
+    the MappedSnapshot is returned, so that it can be published with a
+    single reference swap. The RovIndex of the VRP set is built here too,
+    so that no request waits for it: in 'fork' mode by the arbiter, before
+    the workers are forked, and in 'shared' mode by each worker, before it
+    serves from the snapshot.
+    """
+
+    def __init__(self, vrps, bodies):
+        """Map the VRPSnapshot and BodyStore files of a snapshot."""
+        self.vrps = VRPSnapshot(vrps)
+        try:
+            self.store = BodyStore(bodies)
+        except Exception:
+            self.vrps.close()
+            raise
+        if self.store.generation != self.vrps.generation:
+            self.close()
+            raise ValueError("Snapshot files {} and {} are from different "
+                             "generations".format(vrps, bodies))
+        self.generation = self.store.generation
+        self.index = RovIndex.from_snapshot(self.vrps)
+
+    def close(self):
+        """Unmap the snapshot files."""
+        self.vrps.close()
+        self.store.close()
+
+
+class VRPSnapshot(object):
+    """A memory-mapped binary snapshot of a VRP set.
+
+    The file consists of a fixed header, a table of trust anchor names,
+    and one fixed-width record per VRP:
+
+        header: magic, format version, TA count, generation, VRP count
+        TA table: (length, utf-8 name) for each trust anchor
+        record: asn, address (zero padded to 16 bytes), afi, prefix length,
+                max length, TA table index (or 255 for none)
+    """
+
+    magic = b"RPKV"
+    version = 1
+    header = struct.Struct("!4sHHQI")
+    ta_len = struct.Struct("!H")
+    record = struct.Struct("!I16sBBBB")
+    no_ta = 0xff
+
+    def __init__(self, path):
+        """Open and map an existing snapshot file."""
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, ta_count,
+         self.generation, self.count) = self.header.unpack_from(self.map, 0)
+        if magic != self.magic or version != self.version:
+            self.close()
+            raise ValueError("{} is not a version {} VRP snapshot"
+                             .format(path, self.version))
+        offset = self.header.size
+        self.tas = list()
+        for i in range(ta_count):
+            (length,) = self.ta_len.unpack_from(self.map, offset)
+            offset += self.ta_len.size
+            self.tas.append(self.map[offset:offset + length].decode("utf-8"))
+            offset += length
+        self.offset = offset
+
+    def __len__(self):
+        """Get the number of VRPs in the snapshot."""
+        return self.count
+
+    def __iter__(self):
+        """Yield each VRP in the snapshot."""
+        for (asn, afi, addr, length, max_length, ta) in self.records():
+            ta = None if ta == self.no_ta else self.tas[ta]
+            yield VRP.from_fields(asn, afi, addr, length, max_length, ta)
+
+    def records(self):
+        """Yield the raw fields of each VRP, without creating VRP objects.
+
+        Fields are in the order taken by VRP.from_fields(), except that the
+        trust anchor is given as its TA table index.
+        """
+        unpack_from = self.record.unpack_from
+        size = self.record.size
+        for offset in range(self.offset, self.offset + self.count * size,
+                            size):
+            (asn, addr, afi, length,
+             max_length, ta) = unpack_from(self.map, offset)
+            if afi == 4:
+                addr = addr[:4]
+            yield (asn, afi, addr, length, max_length, ta)
+
+    def __enter__(self):
+        """Enter a context manager."""
+        return self
+
+    def __exit__(self, *exc):
+        """Unmap the snapshot on leaving a context manager."""
+        self.close()
+
+    def close(self):
+        """Unmap the snapshot file."""
+        self.map.close()
+
+    def vrps(self):
+        """Load the snapshot into a VRPSet."""
+        return VRPSet(self)
+
+    @classmethod
+    def write(cls, path, vrps, generation):
+        """Atomically write 'vrps' to a snapshot file at 'path'."""
+        tas = sorted(set(vrp.ta for vrp in vrps if vrp.ta is not None))
+        if len(tas) >= cls.no_ta:
+            raise ValueError("Too many trust anchors for snapshot format")
+        ta_index = {ta: i for i, ta in enumerate(tas)}
+        ta_index[None] = cls.no_ta
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, "wb") as f:
+            f.write(cls.header.pack(cls.magic, cls.version, len(tas),
+                                    generation, len(vrps)))
+            for ta in tas:
+                name = ta.encode("utf-8")
+                f.write(cls.ta_len.pack(len(name)))
+                f.write(name)
+            pack = cls.record.pack
+            for vrp in vrps:
+                (asn, afi, addr, length, max_length, ta) = vrp.parsed
+                f.write(pack(asn, addr, afi, length, max_length,
+                             ta_index[ta]))
+        os.rename(tmp_path, path)
+        return path
+
+
+def _copy(src, dst, sync=False):
+    """Atomically copy the file 'src' to 'dst', optionally syncing it."""
+    tmp_path = "{}.tmp".format(dst)
+    with open(src, "rb") as f_src, open(tmp_path, "wb") as f_dst:
+        shutil.copyfileobj(f_src, f_dst)
+        if sync:
+            f_dst.flush()
+            os.fsync(f_dst.fileno())
+    os.rename(tmp_path, dst)
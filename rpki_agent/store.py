@@ -0,0 +1,238 @@
+# Copyright (c) 2019 Ben Maddison. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""rpki_agent shared rendered body store."""
+
+from __future__ import print_function
+
+import binascii
+import calendar
+import collections
+import datetime
+import json
+import mmap
+import os
+import struct
+
+
+StoredBody = collections.namedtuple("StoredBody",
+                                    ("data", "gzipped", "etag", "modified"))
+
+
+class BodyStore(object):
+    """A read-only, memory-mapped store of rendered response bodies.
+
+    The file consists of a fixed header, a JSON metadata object, a table of
+    fixed-width entries sorted by key, and the concatenated body data:
+
+        header: magic, format version, generation, metadata length,
+                entry count
+        entry: kind (covered or origin), afi, origin, data offset and
+               length, gzip data offset and length, modification time and
+               entity-tag
+
+    Lookups binary search the mapped entry table, so that no per-process
+    index needs to be built, and the data is shared between every process
+    that maps the file.
+    """
+
+    magic = b"RPKB"
+    version = 2
+    header = struct.Struct("!4sHQII")
+    key = struct.Struct("!BBI")
+    entry = struct.Struct("!BBIQIQIQ20s")
+    covered, origin = 0, 1
+    afis = {"ipv4": 4, "ipv6": 6}
+
+    def __init__(self, path):
+        """Open and map an existing body store file."""
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.generation,
+         metadata_len, self.count) = self.header.unpack_from(self.map, 0)
+        if magic != self.magic or version != self.version:
+            self.close()
+            raise ValueError("{} is not a version {} body store"
+                             .format(path, self.version))
+        self.table = self.header.size + metadata_len
+        self.metadata = json.loads(self.map[self.header.size:self.table]
+                                   .decode("utf-8"))
+        self.data = self.table + self.count * self.entry.size
+
+    @property
+    def modified(self):
+        """Get the generation time of the stored data."""
+        return datetime.datetime.utcfromtimestamp(self.generation / 1000.0)
+
+    def __enter__(self):
+        """Enter a context manager."""
+        return self
+
+    def __exit__(self, *exc):
+        """Unmap the body store on leaving a context manager."""
+        self.close()
+
+    def close(self):
+        """Unmap the body store file."""
+        self.map.close()
+
+    @classmethod
+    def make_key(cls, afi, origin=None):
+        """Pack the lookup key of a body, or return None if invalid."""
+        try:
+            if origin is None:
+                return cls.key.pack(cls.covered, cls.afis[afi], 0)
+            return cls.key.pack(cls.origin, cls.afis[afi], int(origin))
+        except (KeyError, ValueError, struct.error):
+            return None
+
+    def bisect(self, key):
+        """Get the table offset of the first entry not less than 'key'."""
+        (lo, hi) = (0, self.count)
+        size = self.entry.size
+        width = self.key.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = self.table + mid * size
+            if self.map[offset:offset + width] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return self.table + lo * size
+
+    def find(self, afi, origin=None):
+        """Get the table offset of a body's entry, or None if absent."""
+        key = self.make_key(afi, origin)
+        if key is None:
+            return None
+        offset = self.bisect(key)
+        if (offset < self.data and
+                self.map[offset:offset + self.key.size] == key):
+            return offset
+        return None
+
+    def origins(self, afi):
+        """Yield the origins with a body for 'afi', in numerical order."""
+        start = self.make_key(afi, 0)
+        if start is None:
+            return
+        offset = self.bisect(start)
+        while offset < self.data:
+            (kind, number, origin) = self.key.unpack_from(self.map, offset)
+            if kind != self.origin or number != self.afis[afi]:
+                return
+            yield str(origin)
+            offset += self.entry.size
+
+    def get(self, afi, origin=None):
+        """Get a StoredBody, or None if absent."""
+        offset = self.find(afi, origin)
+        if offset is None:
+            return None
+        return self._body(offset)
+
+    def bodies(self):
+        """Get all stored bodies, in the form taken by write().
+
+        Returns a (covered, for_origin) tuple, where 'covered' maps each afi
+        to a StoredBody, and 'for_origin' maps each afi to a dict of
+        StoredBody objects keyed by origin.
+        """
+        names = {number: afi for afi, number in self.afis.items()}
+        covered = dict()
+        for_origin = {afi: dict() for afi in self.afis}
+        for offset in range(self.table, self.data, self.entry.size):
+            (kind, afi, origin) = self.key.unpack_from(self.map, offset)
+            if kind == self.covered:
+                covered[names[afi]] = self._body(offset)
+            else:
+                for_origin[names[afi]][str(origin)] = self._body(offset)
+        return (covered, for_origin)
+
+    def entries(self):
+        """Yield (afi, origin, etag) for each stored body, in key order.
+
+        'origin' is None for the covered body of an address-family. Only
+        the entry table is read, not the body data.
+        """
+        names = {number: afi for afi, number in self.afis.items()}
+        for offset in range(self.table, self.data, self.entry.size):
+            (kind, afi, origin, _, _, _, _,
+             _, etag) = self.entry.unpack_from(self.map, offset)
+            yield (names[afi], None if kind == self.covered else str(origin),
+                   binascii.hexlify(etag).decode("ascii"))
+
+    def _body(self, offset):
+        """Read the StoredBody whose entry is at 'offset'."""
+        (_, _, _, data_offset, data_len, gz_offset, gz_len,
+         modified, etag) = self.entry.unpack_from(self.map, offset)
+        data_offset += self.data
+        data = self.map[data_offset:data_offset + data_len]
+        if gz_len:
+            gz_offset += self.data
+            gzipped = self.map[gz_offset:gz_offset + gz_len]
+        else:
+            gzipped = None
+        if modified:
+            modified = datetime.datetime.utcfromtimestamp(modified / 1000.0)
+        else:
+            modified = None
+        return StoredBody(data, gzipped,
+                          binascii.hexlify(etag).decode("ascii"), modified)
+
+    @classmethod
+    def write(cls, path, generation, covered, for_origin, metadata=None):
+        """Atomically write rendered bodies to a body store file at 'path'.
+
+        'covered' maps each afi to a RenderedBody, and 'for_origin' maps
+        each afi to a dict of RenderedBody objects keyed by origin.
+        'metadata' is an optional JSON serialisable dict.
+        """
+        metadata = json.dumps(metadata or {}, sort_keys=True).encode("utf-8")
+        bodies = list()
+        for afi, body in covered.items():
+            bodies.append((cls.make_key(afi), body))
+        for afi, origins in for_origin.items():
+            for origin, body in origins.items():
+                bodies.append((cls.make_key(afi, origin), body))
+        bodies.sort(key=lambda item: item[0])
+        entries = list()
+        offset = 0
+        for key, body in bodies:
+            data_offset = offset
+            offset += len(body.data)
+            if body.gzipped is not None:
+                (gz_offset, gz_len) = (offset, len(body.gzipped))
+                offset += gz_len
+            else:
+                (gz_offset, gz_len) = (0, 0)
+            if body.modified is not None:
+                modified = (calendar.timegm(body.modified.utctimetuple()) *
+                            1000 + body.modified.microsecond // 1000)
+            else:
+                modified = 0
+            entries.append(cls.key.unpack(key) +
+                           (data_offset, len(body.data), gz_offset, gz_len,
+                            modified, binascii.unhexlify(body.etag)))
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, "wb") as f:
+            f.write(cls.header.pack(cls.magic, cls.version, generation,
+                                    len(metadata), len(entries)))
+            f.write(metadata)
+            for entry in entries:
+                f.write(cls.entry.pack(*entry))
+            for key, body in bodies:
+                f.write(body.data)
+                if body.gzipped is not None:
+                    f.write(body.gzipped)
+        os.rename(tmp_path, path)
+        return path
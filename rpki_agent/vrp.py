@@ -14,52 +14,149 @@
 
 from __future__ import print_function
 
+import binascii
 import collections
-import ipaddress
+import socket
 
-from aggregate_prefixes.aggregate_prefixes import aggregate_prefixes
+from rpki_agent.aggregate import aggregate
 
+# trust anchor names are shared between all VRPs that refer to them
+_ta_names = dict()
 
-class VRP(collections.Mapping):
-    """A validated ROA payload object."""
 
-    def __init__(self, **kwargs):
+class VRP(object):
+    """A validated ROA payload object.
+
+    The record is parsed once at construction time and stored compactly:
+    the origin as an integer, the network address as packed bytes, and the
+    prefix length and address-family as integers. The original export keys
+    remain available through the Mapping interface.
+
+    VRP is registered as a virtual subclass of collections.Mapping rather
+    than inheriting from it, because the Mapping base classes do not define
+    __slots__ on all supported python versions.
+    """
+
+    __slots__ = ("_asn", "_addr", "_len", "_afi", "maxLength", "ta")
+
+    fields = ("asn", "prefix", "maxLength", "ta")
+    families = {4: socket.AF_INET, 6: socket.AF_INET6}
+
+    def __init__(self, asn, prefix, maxLength, ta=None, **kwargs):
         """Initialize a VRP."""
-        self.as_dict = kwargs
-        for k, v in kwargs.items():
-            setattr(self, k, v)
+        address, length = prefix.split("/")
+        self._afi = 6 if ":" in address else 4
+        self._addr = socket.inet_pton(self.families[self._afi], address)
+        self._len = int(length)
+        self._asn = int(str(asn).lstrip("AS"))
+        self.maxLength = int(maxLength)
+        self.ta = _ta_names.setdefault(ta, ta)
+
+    @classmethod
+    def from_fields(cls, asn, afi, addr, length, maxLength, ta=None):
+        """Create a VRP directly from its already parsed fields."""
+        vrp = cls.__new__(cls)
+        vrp.__setstate__((asn, addr, length, afi, maxLength, ta))
+        return vrp
+
+    @classmethod
+    def from_network(cls, asn, afi, network, maxLength, ta=None):
+        """Create a VRP from an (integer address, length) pair."""
+        (address, length) = network
+        digits = {4: 8, 6: 32}[afi]
+        addr = binascii.unhexlify("{:0{}x}".format(address, digits))
+        return cls.from_fields(asn, afi, addr, length, maxLength, ta)
 
     def __getitem__(self, key):
         """Implement item retrieval."""
-        return self.as_dict.__getitem__(key)
+        if key not in self.fields:
+            raise KeyError(key)
+        return getattr(self, key)
 
     def __iter__(self):
         """Implement iteration."""
-        return self.as_dict.__iter__()
+        return iter(self.fields)
 
     def __len__(self):
         """Implement sizing."""
-        return self.as_dict.__len__()
+        return len(self.fields)
+
+    def __contains__(self, key):
+        """Implement membership."""
+        return key in self.fields
+
+    def keys(self):
+        """Get the list of keys."""
+        return list(self.fields)
+
+    def values(self):
+        """Get the list of values."""
+        return [self[k] for k in self.fields]
+
+    def items(self):
+        """Get the list of (key, value) pairs."""
+        return [(k, self[k]) for k in self.fields]
+
+    def get(self, key, default=None):
+        """Get the value of key, or default if it is not present."""
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __getstate__(self):
+        """Get the compact state for pickling."""
+        return (self._asn, self._addr, self._len, self._afi,
+                self.maxLength, self.ta)
+
+    def __setstate__(self, state):
+        """Restore the compact state after unpickling."""
+        (self._asn, self._addr, self._len, self._afi,
+         self.maxLength, ta) = state
+        self.ta = _ta_names.setdefault(ta, ta)
+
+    @property
+    def parsed(self):
+        """Get the parsed fields, in the order taken by from_fields()."""
+        return (self._asn, self._afi, self._addr, self._len,
+                self.maxLength, self.ta)
+
+    @property
+    def asn(self):
+        """Get the origin AS of the VRP in 'ASn' notation."""
+        return "AS{}".format(self._asn)
+
+    @property
+    def prefix(self):
+        """Get the prefix of the VRP in CIDR notation."""
+        return "{}/{}".format(socket.inet_ntop(self.families[self._afi],
+                                               self._addr),
+                              self._len)
+
+    @property
+    def network(self):
+        """Get the prefix of the VRP as an (integer address, length) pair."""
+        return (int(binascii.hexlify(self._addr), 16), self._len)
 
     @property
     def afi(self):
         """Get the address-family of the VRP."""
-        return "ipv{}".format(ipaddress.ip_network(self.prefix).version)
+        return "ipv{}".format(self._afi)
 
     @property
     def key(self):
         """Get a hashable tuple of attributes."""
-        return (self.asn, self.prefix, self.maxLength, self.ta)
+        return (self._asn, self._addr, self._len, self.maxLength, self.ta)
 
     @property
     def as_number(self):
         """Get the bare AS number of the VRP."""
-        return self.asn.lstrip("AS")
+        return str(self._asn)
 
     @property
     def prefix_len(self):
         """Get the prefix length of self.prefix."""
-        return ipaddress.ip_network(self.prefix).prefixlen
+        return self._len
 
     @property
     def len_range(self):
@@ -70,9 +167,24 @@ class VRP(collections.Mapping):
         """Make VRP objects hashable."""
         return hash(self.key)
 
+    def __eq__(self, other):
+        """Compare VRP objects by their attributes."""
+        if isinstance(other, VRP):
+            return self.key == other.key
+        if isinstance(other, collections.Mapping):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        """Compare VRP objects by their attributes."""
+        return not self == other
+
     def __repr__(self):
         """Representation as a dict."""
-        return self.as_dict.__repr__()
+        return dict(self).__repr__()
+
+
+collections.Mapping.register(VRP)
 
 
 class VRPSet(collections.Set):
@@ -81,6 +193,7 @@ class VRPSet(collections.Set):
     def __init__(self, iterable):
         """Initialise a VRPSet."""
         self.elements = set(iterable)
+        self._index = None
 
     def __iter__(self):
         """Implement iteration."""
@@ -94,20 +207,69 @@ class VRPSet(collections.Set):
         """Implement sizing."""
         return self.elements.__len__()
 
+    def __getstate__(self):
+        """Exclude the origin index from pickled state."""
+        return {"elements": self.elements, "_index": None}
+
+    @property
+    def index(self):
+        """Get the VRPs grouped by address-family and origin AS.
+
+        The index is built lazily, in a single pass over the set, and takes
+        the form {afi: {origin: [VRP, ...]}}.
+        """
+        if self._index is None:
+            index = {"ipv4": collections.defaultdict(list),
+                     "ipv6": collections.defaultdict(list)}
+            for vrp in self:
+                index[vrp.afi][vrp.as_number].append(vrp)
+            self._index = {afi: dict(origins)
+                           for afi, origins in index.items()}
+        return self._index
+
+    def diff(self, previous):
+        """Return the (added, removed) VRPSets relative to 'previous'."""
+        return (VRPSet(self.elements - previous.elements),
+                VRPSet(previous.elements - self.elements))
+
+    def update(self, added, removed):
+        """Apply added and removed VRPs to the set in place.
+
+        Returns the origins whose VRPs changed, as {afi: set(origins)}.
+        """
+        affected = {"ipv4": set(), "ipv6": set()}
+        for vrp in removed:
+            if vrp not in self.elements:
+                continue
+            self.elements.remove(vrp)
+            affected[vrp.afi].add(vrp.as_number)
+            if self._index is not None:
+                entries = self._index[vrp.afi][vrp.as_number]
+                entries.remove(vrp)
+                if not entries:
+                    del self._index[vrp.afi][vrp.as_number]
+        for vrp in added:
+            if vrp in self.elements:
+                continue
+            self.elements.add(vrp)
+            affected[vrp.afi].add(vrp.as_number)
+            if self._index is not None:
+                self._index[vrp.afi].setdefault(vrp.as_number, []).append(vrp)
+        return affected
+
     def covered(self, afi):
         """Return a VRPSet of pseudo VRPs covered by the VRP set."""
-        prefixes = aggregate_prefixes([vrp.prefix for vrp in self
-                                       if vrp.afi == afi])
-        maxlen = {"ipv4": 32, "ipv6": 128}
-        return VRPSet([VRP(asn="AS0", prefix=p, maxLength=maxlen[afi], ta=None)
-                       for p in prefixes])
+        (version, width) = {"ipv4": (4, 32), "ipv6": (6, 128)}[afi]
+        prefixes = aggregate([vrp.network
+                              for vrps in self.index[afi].values()
+                              for vrp in vrps], width)
+        return VRPSet([VRP.from_network(0, version, network, width)
+                       for network in prefixes])
 
     def origins(self, afi):
         """Return a set of origins in the VRP set."""
-        return set([vrp.as_number for vrp in self
-                    if vrp.afi == afi and vrp.asn != "AS0"])
+        return set(self.index[afi]) - {"0"}
 
     def for_origin(self, origin, afi):
         """Return the VRPSet of VRPs with the given origin AS."""
-        return VRPSet([vrp for vrp in self
-                       if vrp.as_number == origin and vrp.afi == afi])
+        return VRPSet(self.index[afi].get(origin, ()))
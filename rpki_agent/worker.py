@@ -13,55 +13,336 @@
 
 from __future__ import print_function
 
+import datetime
+import email.utils
+import hashlib
+import itertools
 import multiprocessing
+import os
 import signal
+import threading
+import time
 
 import pyeapi
 import requests
 
 from rpki_agent.base import RpkiBase
-from rpki_agent.vrp import VRP, VRPSet
 from rpki_agent.exceptions import handle_sigterm, TermException
+from rpki_agent.export import export_time, ExportStream
+from rpki_agent.metrics import Spans
+from rpki_agent.push import EapiPush
+from rpki_agent.render import prefix_list_lines, RenderedBody
+from rpki_agent.snapshot import Snapshot, VRPSnapshot
+from rpki_agent.store import BodyStore
+from rpki_agent.vrp import VRP, VRPSet
 
 
 class RpkiWorker(multiprocessing.Process, RpkiBase):
-    """Worker to fetch and process RPKI VRP data."""
+    """Worker to fetch and process RPKI VRP data.
+
+    By default, a worker runs a single fetch cycle and exits. A persistent
+    worker instead waits after each cycle for a 'refresh' command from the
+    agent on the data pipe, and keeps its eAPI connection, HTTP sessions
+    and the last fetched VRP set between cycles.
+    """
 
-    def __init__(self, cache_url, *args, **kwargs):
+    chunk_size = 64 * 1024
+    timeout = 30
+    persistent = False
+    # whether the worker follows the cache itself, rather than fetching on
+    # command from the agent
+    follows = False
+
+    def __init__(self, cache_urls, data_dir, validators=None, previous=None,
+                 processes=None, persist_dir=None, persistent=False,
+                 delivery="listener", *args, **kwargs):
         """Initialise an RpkiWorker instance."""
         super(RpkiWorker, self).__init__(*args, **kwargs)
         RpkiBase.__init__(self)
-        self.cache_url = cache_url
+        self.created = time.time()
+        self.cache_urls = list(cache_urls)
+        self.cache_stats = dict()
+        self.sessions = dict()
+        self.data_dir = data_dir
+        self.validators = dict(validators or {})
+        self.previous = previous
+        self.last_vrps = None
+        self.processes = processes or 1
+        self.persist_dir = persist_dir
+        self.persistent = persistent or self.persistent
+        self.delivery = delivery
+        self.pusher = None
+        self.spans = Spans()
         self.p_err, self.c_err = multiprocessing.Pipe(duplex=False)
-        self.p_data, self.c_data = multiprocessing.Pipe(duplex=False)
+        self.p_data, self.c_data = multiprocessing.Pipe()
 
     def run(self):
         """Run the worker process."""
         self.info("Worker started")
         signal.signal(signal.SIGTERM, handle_sigterm)
         try:
-            stats = dict()
             self.node = self.connect_eapi()
-            vrps = self.fetch()
-            all_origins = set()
-            self.info("Calculating statistics")
-            for afi in ("ipv4", "ipv6"):
-                covered = vrps.covered(afi)
-                origins = vrps.origins(afi)
-                stats["covered_prefixes_{}".format(afi)] = len(covered)
-                stats["origin_asns_{}".format(afi)] = len(origins)
-                all_origins.update(origins)
-            stats["origin_asns_total"] = len(all_origins)
-            self.c_data.send((stats, vrps))
+            dispatched = self.created
+            while True:
+                self.run_cycle(dispatched)
+                if not self.persistent:
+                    return
+                dispatched = self.receive()
+                if dispatched is None:
+                    return
         except TermException:
             self.notice("Got SIGTERM signal: exiting.")
         except Exception as e:
-            self.err(e)
-            self.c_err.send(e)
+            self.report_error(e)
         finally:
+            for session in self.sessions.values():
+                session.close()
             self.c_err.close()
             self.c_data.close()
 
+    def run_cycle(self, dispatched):
+        """Run a cycle, and send its result to the agent.
+
+        'dispatched' is the time at which the agent dispatched the cycle.
+        The error of a failed cycle is raised, unless the worker is
+        persistent, in which case it is reported instead.
+        """
+        overhead = time.time() - dispatched
+        try:
+            (stats, snapshot) = self.cycle()
+        except Exception as e:
+            if not self.persistent:
+                raise
+            self.report_error(e)
+            return
+        stats["worker_overhead_ms"] = int(overhead * 1000)
+        self.c_data.send((stats, snapshot, self.validators))
+
+    def receive(self):
+        """Wait for the next command from the agent.
+
+        Returns the time at which the command was dispatched, or None if
+        the agent has closed the command channel.
+        """
+        try:
+            (command, dispatched,
+             validators, previous) = self.c_data.recv()
+        except EOFError:
+            self.notice("Command channel closed: exiting.")
+            return None
+        self.info("Got '{}' command".format(command))
+        self.validators = dict(validators or {})
+        self.previous = previous
+        return dispatched
+
+    def report_error(self, e):
+        """Trace an error, and send it to the agent."""
+        self.err(e)
+        self.c_err.send(e)
+
+    def cycle(self):
+        """Fetch and process the VRP set once.
+
+        If the VRP set processed in the previous cycle is still held, and
+        is that of the previous snapshot, the changes are computed against
+        it in memory.
+
+        The timing and peak memory of each stage are included in the
+        statistics.
+        """
+        self.spans = Spans()
+        vrps = self.fetch()
+        if vrps is None:
+            stats = dict(self.cache_stats)
+            stats.update(self.spans.stats)
+            # retry delivery of the previous snapshot if it failed
+            self.deliver(self.previous, stats)
+            return (stats, None)
+        delta = None
+        if (self.last_vrps is not None and self.previous is not None and
+                self.last_vrps[0] == self.previous.generation):
+            self.info("Calculating changes to VRP set in memory")
+            with self.spans.span("diff"):
+                delta = vrps.diff(self.last_vrps[1])
+        (stats, snapshot) = self.process(vrps, delta=delta)
+        if snapshot is not None:
+            self.last_vrps = (snapshot.generation, vrps)
+        stats.update(self.cache_stats)
+        stats.update(self.spans.stats)
+        self.deliver(snapshot or self.previous, stats)
+        return (stats, snapshot)
+
+    def deliver(self, snapshot, stats):
+        """Push a processed snapshot over eAPI, if so configured.
+
+        The push statistics are added to 'stats'. Failures are reported,
+        but do not fail the cycle, since the listener can still serve the
+        snapshot.
+        """
+        if self.delivery != "eapi" or snapshot is None:
+            return
+        if self.pusher is None:
+            self.pusher = EapiPush(self.node, self.data_dir)
+        try:
+            stats.update(self.pusher.push(snapshot))
+        except Exception as e:
+            self.warning("Pushing config over eAPI failed: {}".format(e))
+            stats["eapi_push_result"] = "failed"
+
+    def process(self, vrps, delta=None):
+        """Process a VRP set into a complete processed snapshot.
+
+        The VRP set is compared with the previous snapshot, if any, and only
+        the config objects affected by the changes are re-rendered. If the
+        (added, removed) changes relative to the previous snapshot are
+        already known, they may be given as 'delta'. Returns the statistics
+        and the new Snapshot, or None for the Snapshot if the VRP set is
+        unchanged.
+        """
+        stats = dict()
+        if self.previous is None:
+            (added, removed) = (vrps, VRPSet([]))
+            affected = None
+        else:
+            if delta is not None:
+                (added, removed) = delta
+            else:
+                self.info("Calculating changes to VRP set")
+                with self.spans.span("diff"), \
+                        VRPSnapshot(self.previous.vrps) as snapshot:
+                    (added, removed) = vrps.diff(snapshot.vrps())
+            if not (added or removed):
+                self.info("VRP set unchanged")
+                return (stats, None)
+            affected = {afi: set(added.index[afi]).union(removed.index[afi])
+                        for afi in ("ipv4", "ipv6")}
+        stats["vrps_added"] = len(added)
+        stats["vrps_removed"] = len(removed)
+        # AS0 VRPs change the covered prefix-lists, but have no prefix-list
+        # of their own
+        stats["origins_affected"] = sum(len(set(added.index[afi])
+                                            .union(removed.index[afi]) -
+                                            {"0"})
+                                        for afi in ("ipv4", "ipv6"))
+        generation = int(time.time() * 1000)
+        with self.spans.span("render"):
+            (covered, for_origin) = self.render(vrps, generation, affected,
+                                                stats)
+        snapshot = Snapshot(generation=generation,
+                            vrps=os.path.join(self.data_dir,
+                                              "vrps-{}.bin"
+                                              .format(generation)),
+                            bodies=os.path.join(self.data_dir,
+                                                "bodies-{}.bin"
+                                                .format(generation)))
+        with self.spans.span("write"):
+            self.info("Writing VRP snapshot to {}".format(snapshot.vrps))
+            VRPSnapshot.write(snapshot.vrps, vrps, generation)
+            self.info("Writing rendered data to {}".format(snapshot.bodies))
+            BodyStore.write(snapshot.bodies, generation, covered, for_origin,
+                            metadata=stats)
+        if self.persist_dir is not None:
+            self.info("Persisting snapshot to {}".format(self.persist_dir))
+            try:
+                with self.spans.span("persist"):
+                    snapshot.persist(self.persist_dir)
+            except (IOError, OSError) as e:
+                self.warning("Persisting snapshot failed: {}".format(e))
+        return (stats, snapshot)
+
+    def render(self, vrps, generation, affected, stats):
+        """Render the config objects for a VRP set.
+
+        If 'affected' is given, as {afi: set(origins)}, the bodies of the
+        previous snapshot are re-used for all other origins, and for the
+        covered prefix-list of each address-family without changes.
+        Statistics are added to 'stats'.
+
+        If more than one process is configured, the aggregation of each
+        address-family and the rendering of each shard of origins run as
+        separate tasks in a process pool.
+        """
+        modified = datetime.datetime.utcfromtimestamp(generation / 1000.0)
+        if affected is None:
+            covered = dict()
+            for_origin = {"ipv4": dict(), "ipv6": dict()}
+            metadata = dict()
+        else:
+            with BodyStore(self.previous.bodies) as store:
+                (covered, for_origin) = store.bodies()
+                metadata = store.metadata
+        tasks = self.render_tasks(vrps, affected, metadata, stats)
+        results = self.run_tasks(vrps, modified, tasks)
+        self.merge_results(tasks, results, covered, for_origin, stats)
+        for afi in ("ipv4", "ipv6"):
+            stats["origin_asns_{}".format(afi)] = len(for_origin[afi])
+        stats["origin_asns_total"] = len(set(for_origin["ipv4"])
+                                         .union(for_origin["ipv6"]))
+        return (covered, for_origin)
+
+    def render_tasks(self, vrps, affected, metadata, stats):
+        """Get the render tasks for a VRP set, as (afi, origins) pairs.
+
+        'origins' is None for the covered prefix-list of 'afi', or else a
+        shard of the origins to render. The covered prefix count of each
+        address-family that is not re-rendered is copied from the
+        'metadata' of the previous snapshot into 'stats'.
+        """
+        tasks = list()
+        for afi in ("ipv4", "ipv6"):
+            if affected is None:
+                origins = vrps.origins(afi)
+            elif affected[afi]:
+                origins = affected[afi] - {"0"}
+            else:
+                covered_stat = "covered_prefixes_{}".format(afi)
+                stats[covered_stat] = metadata[covered_stat]
+                continue
+            self.info("Creating prefix-lists for {} address-family"
+                      .format(afi))
+            tasks.append((afi, None))
+            origins = sorted(origins, key=int)
+            size = max(1, -(-len(origins) // (self.processes * 4)))
+            for i in range(0, len(origins), size):
+                tasks.append((afi, origins[i:i + size]))
+        return tasks
+
+    def run_tasks(self, vrps, modified, tasks):
+        """Run render tasks, in a process pool if so configured."""
+        # build the index before forking, so that it is shared by the pool
+        vrps.index
+        if self.processes <= 1 or len(tasks) <= 1:
+            return [render_task(vrps, modified, afi, origins)
+                    for afi, origins in tasks]
+        self.info("Rendering {} tasks in {} processes"
+                  .format(len(tasks), self.processes))
+        pool = multiprocessing.Pool(self.processes, initializer=_init_pool,
+                                    initargs=(vrps, modified))
+        try:
+            results = pool.map(_render_task, tasks, chunksize=1)
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+        return results
+
+    @staticmethod
+    def merge_results(tasks, results, covered, for_origin, stats):
+        """Merge the results of render tasks into the rendered bodies."""
+        for (afi, origins), result in zip(tasks, results):
+            if origins is None:
+                (count, covered[afi]) = result
+                stats["covered_prefixes_{}".format(afi)] = count
+                continue
+            for asn in origins:
+                if result.get(asn) is None:
+                    for_origin[afi].pop(asn, None)
+                else:
+                    for_origin[afi][asn] = result[asn]
+
     def connect_eapi(self):
         """Connect to the local eapi unix domain socket."""
         self.info("Trying to connect to local eapi endpoint")
@@ -72,16 +353,125 @@ class RpkiWorker(multiprocessing.Process, RpkiBase):
         return node
 
     def fetch(self):
-        """Fetch VRP set from the RPKI validation cache."""
-        self.info("Getting VRP set from {}".format(self.cache_url))
-        with requests.Session() as s:
-            resp = s.get(self.cache_url,
-                         headers={"Accept": "application/json"})
-            data = resp.json()
-        vrps = VRPSet([VRP(**r) for r in data["roas"]])
+        """Fetch VRP set from the freshest available RPKI validation cache.
+
+        Every cache is queried concurrently, and each response is read only
+        as far as the first ROA. The caches that respond within the timeout
+        are ranked by the generation time of their export, taken from its
+        metadata or else the Last-Modified header, and then by latency. The
+        best ranked export is read in full, falling back to the next one if
+        it fails.
+
+        Conditional request headers are only sent to the cache selected on
+        the previous fetch. Returns None if that cache is still the best
+        ranked and reports that the export has not been modified, or if the
+        content of the selected export is identical to that last fetched.
+        Per-cache results are recorded in 'cache_stats'.
+        """
+        self.cache_stats = dict()
+        fetches = [self.cache_fetch(url) for url in self.cache_urls]
+        self.info("Getting VRP set from {} caches".format(len(fetches)))
+        results = self.run_fetches(fetches)
+        candidates = sorted((fetch for fetch, result in zip(fetches, results)
+                             if result in ("ok", "not-modified")),
+                            key=self.rank, reverse=True)
+        try:
+            (fetch, vrps) = self.read(candidates)
+        finally:
+            for other in fetches:
+                other.close()
+        if vrps is None:
+            return None
         self.info("Fetched {} VRPs".format(len(vrps)))
+        last_digest = self.validators.get("digest")
+        self.validators = {"url": fetch.url,
+                           "etag": fetch.headers.get("ETag"),
+                           "last_modified": fetch.headers.get("Last-Modified"),
+                           "timestamp": fetch.timestamp,
+                           "digest": fetch.digest.hexdigest()}
+        if self.validators["digest"] == last_digest:
+            self.info("VRP set content unchanged")
+            return None
         return vrps
 
+    def cache_fetch(self, url):
+        """Create the CacheFetch for a cache."""
+        headers = {"Accept": "application/json"}
+        if url == self.validators.get("url"):
+            if self.validators.get("etag"):
+                headers["If-None-Match"] = self.validators["etag"]
+            if self.validators.get("last_modified"):
+                headers["If-Modified-Since"] = self.validators["last_modified"]
+        session = self.sessions.setdefault(url, requests.Session())
+        return CacheFetch(url, session, headers, timeout=self.timeout,
+                          chunk_size=self.chunk_size)
+
+    def run_fetches(self, fetches):
+        """Run fetches concurrently, and return the result of each.
+
+        The result of a fetch that is still running at the timeout is
+        'timeout'. Its session is closed and discarded, so that the request
+        still in progress does not share a connection pool with those of
+        later cycles.
+        """
+        with self.spans.span("fetch"):
+            for fetch in fetches:
+                fetch.start()
+            deadline = time.time() + self.timeout
+            for fetch in fetches:
+                fetch.join(max(0, deadline - time.time()))
+        results = list()
+        for i, fetch in enumerate(fetches):
+            if fetch.is_alive():
+                result = "timeout"
+                self.sessions.pop(fetch.url, None)
+                fetch.session.close()
+            else:
+                result = fetch.result
+                self.cache_stats["cache_{}_latency_ms".format(i)] = \
+                    int(fetch.latency * 1000)
+            self.cache_stats["cache_{}_url".format(i)] = fetch.url
+            self.cache_stats["cache_{}_result".format(i)] = result
+            self.info("Cache {}: {}".format(fetch.url, result))
+            results.append(result)
+        return results
+
+    def rank(self, fetch):
+        """Get the sort key of a fetch: freshest, then fastest, is highest.
+
+        A cache reporting that the export has not been modified ranks by
+        the generation time of the export last fetched, and ahead of any
+        other cache with the same generation time.
+        """
+        if fetch.result == "not-modified":
+            timestamp = self.validators.get("timestamp")
+        else:
+            timestamp = fetch.timestamp
+        return (timestamp is not None, timestamp or 0,
+                fetch.result == "not-modified", -fetch.latency)
+
+    def read(self, candidates):
+        """Read the VRP set from the best ranked cache that succeeds.
+
+        Returns a (fetch, vrps) tuple for the selected cache, where 'vrps'
+        is None if the export has not been modified.
+        """
+        for fetch in candidates:
+            self.cache_stats["cache_selected"] = fetch.url
+            if fetch.result == "not-modified":
+                self.info("VRP set not modified")
+                return (fetch, None)
+            self.info("Reading VRP set from {}".format(fetch.url))
+            try:
+                with self.spans.span("load"):
+                    return (fetch, VRPSet(VRP(**r) for r in fetch.roas))
+            except (requests.RequestException, ValueError) as e:
+                self.warning("Reading from {} failed: {}"
+                             .format(fetch.url, e))
+        self.cache_stats["cache_selected"] = None
+        raise RuntimeError("No VRP set available from any of {} caches"
+                           .format(len(self.cache_urls)))
+
     @property
     def data(self):
         """Get data from the worker."""
@@ -93,3 +483,118 @@ class RpkiWorker(multiprocessing.Process, RpkiBase):
         """Get exception raised by worker."""
         if self.p_err.poll():
             return self.p_err.recv()
+
+
+class CacheFetch(threading.Thread, RpkiBase):
+    """Fetch the head of the export of one cache in a background thread.
+
+    The export is read only as far as its first ROA, so that any metadata
+    preceding the 'roas' array is available before committing to reading
+    the rest of it from 'roas'.
+    """
+
+    def __init__(self, url, session, headers, timeout, chunk_size):
+        """Initialise a CacheFetch instance."""
+        threading.Thread.__init__(self)
+        RpkiBase.__init__(self)
+        self.daemon = True
+        self.url = url
+        self.session = session
+        self.request_headers = headers
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.resp = None
+        self.result = None
+        self.latency = None
+        self.timestamp = None
+        self.headers = dict()
+        self.digest = hashlib.sha256()
+        self.roas = None
+
+    def run(self):
+        """Make the request and read the export up to its first ROA."""
+        start = time.time()
+        try:
+            resp = self.resp = self.session.get(self.url,
+                                                headers=self.request_headers,
+                                                stream=True,
+                                                timeout=self.timeout)
+            self.headers = resp.headers
+            if resp.status_code == requests.codes.not_modified:
+                self.result = "not-modified"
+                return
+            resp.raise_for_status()
+            chunks = _hashed(resp.iter_content(chunk_size=self.chunk_size),
+                             self.digest)
+            export = ExportStream(chunks)
+            roas = iter(export)
+            head = list(itertools.islice(roas, 1))
+            self.roas = itertools.chain(head, roas)
+            self.timestamp = export_time(export.metadata)
+            if self.timestamp is None:
+                modified = email.utils.parsedate_tz(resp.headers
+                                                    .get("Last-Modified", ""))
+                if modified is not None:
+                    self.timestamp = email.utils.mktime_tz(modified)
+            self.result = "ok"
+        except Exception as e:
+            self.warning("Fetching from {} failed: {}".format(self.url, e))
+            self.result = "error"
+        finally:
+            self.latency = time.time() - start
+
+    def close(self):
+        """Release the connection to the cache.
+
+        A response that was read in full leaves the connection to be
+        re-used by the session, otherwise it is closed.
+        """
+        if self.resp is not None:
+            self.resp.close()
+
+
+def _hashed(chunks, digest):
+    """Update digest with each chunk as it passes through."""
+    for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+
+
+def render_task(vrps, modified, afi, origins=None):
+    """Render the covered prefix-list, or those of a shard of origins.
+
+    If 'origins' is None, returns a (count, body) tuple for the covered
+    prefix-list of 'afi'. Otherwise, returns a dict mapping each origin to
+    its body, or to None if the origin has no VRPs in 'afi'.
+    """
+    if origins is None:
+        prefixes = vrps.covered(afi)
+        return (len(prefixes), RenderedBody(prefix_list_lines(prefixes),
+                                            modified=modified))
+    bodies = dict()
+    for asn in origins:
+        entries = vrps.index[afi].get(asn)
+        if entries:
+            bodies[asn] = RenderedBody(prefix_list_lines(entries),
+                                       modified=modified)
+        else:
+            bodies[asn] = None
+    return bodies
+
+
+# the VRP set being rendered, inherited by each pool process on fork
+_pool_args = None
+
+
+def _init_pool(vrps, modified):
+    """Store the arguments shared by every task in a pool process."""
+    global _pool_args
+    # pool processes are stopped by the worker, not by handle_sigterm
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    _pool_args = (vrps, modified)
+
+
+def _render_task(task):
+    """Run render_task() in a pool process."""
+    (afi, origins) = task
+    return render_task(*(_pool_args + (afi, origins)))
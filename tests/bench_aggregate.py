@@ -0,0 +1,67 @@
+# Copyright (c) 2019 Ben Maddison. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""Benchmark of covered prefix aggregation.
+
+The prefixes of a synthetic VRP set are aggregated per address-family
+with rpki_agent.aggregate, and, if the aggregate-prefixes package is
+installed, with aggregate_prefixes from prefix strings, as was done
+before. The results of the two are checked to be the same:
+
+    python tests/bench_aggregate.py --vrps 525000
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+from helpers import synthetic_vrps
+
+from rpki_agent.aggregate import aggregate
+
+try:
+    from aggregate_prefixes.aggregate_prefixes import aggregate_prefixes
+except ImportError:
+    aggregate_prefixes = None
+
+
+def timed(func, *args):
+    """Call 'func', and return (seconds, result)."""
+    start = time.time()
+    result = func(*args)
+    return (time.time() - start, result)
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vrps", type=int, default=525000)
+    args = parser.parse_args()
+    vrps = synthetic_vrps(args.vrps)
+    for afi, width in (("ipv4", 32), ("ipv6", 128)):
+        members = [vrp for entries in vrps.index[afi].values()
+                   for vrp in entries]
+        (seconds, result) = timed(aggregate,
+                                  [vrp.network for vrp in members], width)
+        line = "{}, {} prefixes: aggregate {:.2f}s".format(afi, len(members),
+                                                           seconds)
+        if aggregate_prefixes is not None:
+            (reference, expected) = timed(
+                lambda: list(aggregate_prefixes([vrp.prefix
+                                                 for vrp in members])))
+            assert len(expected) == len(result)
+            line += ", aggregate_prefixes {:.2f}s".format(reference)
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+# Copyright (c) 2019 Ben Maddison. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""Load benchmark for the listener concurrency models.
+
+Each configuration, given as 'mode:worker_class:workers:threads', is run
+in turn against the same synthetic VRP set. The listener is loaded by
+client processes requesting the existing routes round-robin, and the
+throughput is reported along with the total RSS and PSS of the gunicorn
+arbiter and its workers once the load has finished:
+
+    python tests/bench_listener.py --vrps 100000 fork:sync:2:1 \\
+        fork:gthread:1:4 shared:sync:2:1 shared:gthread:1:4
+"""
+
+from __future__ import print_function
+
+import argparse
+import itertools
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import requests
+
+from helpers import synthetic_vrps
+
+from rpki_agent.listener import RpkiListener
+from rpki_agent.worker import RpkiWorker
+
+base_url = "http://127.0.0.1:8000"
+defaults = ["fork:sync:2:1", "fork:gthread:1:4",
+            "shared:sync:2:1", "shared:gthread:1:4"]
+
+
+def paths(vrps, count=200):
+    """Get the paths to request: a sample of every existing route."""
+    origins = sorted(vrps.origins("ipv4"))[:count]
+    vrp = next(iter(vrps))
+    paths = ["/prefix-lists/ipv4/covered", "/prefix-lists/ipv6/covered",
+             "/metrics",
+             "/validate?prefix={}&origin={}".format(vrp.prefix, vrp.asn)]
+    for origin in origins:
+        paths.append("/prefix-lists/ipv4/origin/{}".format(origin))
+        paths.append("/as-paths/{}".format(origin))
+    return paths
+
+
+def client(paths, deadline, results):
+    """Request 'paths' round-robin until 'deadline'."""
+    session = requests.Session()
+    (ok, failed) = (0, 0)
+    for path in itertools.cycle(paths):
+        if time.time() >= deadline:
+            break
+        try:
+            resp = session.get(base_url + path)
+            resp.content
+        except requests.RequestException:
+            failed += 1
+            continue
+        if resp.status_code == 200:
+            ok += 1
+        else:
+            failed += 1
+    results.put((ok, failed))
+
+
+def children(pid):
+    """Get the pids of the children of a process."""
+    pids = list()
+    for entry in os.listdir("/proc"):
+        try:
+            with open("/proc/{}/stat".format(entry)) as f:
+                if int(f.read().rsplit(")", 1)[1].split()[1]) == pid:
+                    pids.append(int(entry))
+        except (IOError, OSError, ValueError, IndexError):
+            continue
+    return pids
+
+
+def memory(pid):
+    """Get the total (RSS, PSS) of a process and its children, in KiB."""
+    totals = {"Rss:": 0, "Pss:": 0}
+    for pid in [pid] + children(pid):
+        try:
+            with open("/proc/{}/smaps_rollup".format(pid)) as f:
+                for line in f:
+                    (name, value) = line.split()[:2]
+                    if name in totals:
+                        totals[name] += int(value)
+        except (IOError, OSError):
+            continue
+    return (totals["Rss:"], totals["Pss:"])
+
+
+def wait_ready(timeout=60):
+    """Wait until the listener serves the loaded snapshot."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(base_url + "/prefix-lists/ipv4/covered",
+                            timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Listener did not start")
+
+
+def run(config, vrps, duration, clients):
+    """Run one configuration, and return its result."""
+    (mode, worker_class, workers, threads) = config.split(":")
+    data_dir = tempfile.mkdtemp()
+    listener = None
+    try:
+        snapshot = RpkiWorker([], data_dir).process(vrps)[1]
+        listener = RpkiListener(mode=mode, data_dir=data_dir,
+                                worker_class=worker_class,
+                                workers=int(workers), threads=int(threads))
+        # the snapshot is waiting to be received when the listener starts
+        listener.p_data.send_snapshot(snapshot)
+        listener.start()
+        wait_ready()
+        results = multiprocessing.Queue()
+        deadline = time.time() + duration
+        procs = [multiprocessing.Process(target=client,
+                                         args=(paths(vrps), deadline,
+                                               results))
+                 for _ in range(clients)]
+        for proc in procs:
+            proc.start()
+        totals = [results.get() for _ in procs]
+        for proc in procs:
+            proc.join()
+        (rss, pss) = memory(listener.pid)
+        return {"config": config,
+                "rps": sum(ok for ok, _ in totals) / float(duration),
+                "failed": sum(failed for _, failed in totals),
+                "rss_mb": rss / 1024.0, "pss_mb": pss / 1024.0}
+    finally:
+        if listener is not None and listener.is_alive():
+            listener.terminate()
+            listener.join()
+        shutil.rmtree(data_dir)
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("configs", nargs="*", default=defaults)
+    parser.add_argument("--vrps", type=int, default=100000)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--clients", type=int, default=4)
+    args = parser.parse_args()
+    vrps = synthetic_vrps(args.vrps)
+    print("{:<24} {:>10} {:>8} {:>10} {:>10}"
+          .format("config", "req/s", "failed", "rss MiB", "pss MiB"))
+    for config in args.configs:
+        result = run(config, vrps, args.duration, args.clients)
+        print("{config:<24} {rps:>10.1f} {failed:>8} {rss_mb:>10.1f} "
+              "{pss_mb:>10.1f}".format(**result))
+
+
+if __name__ == "__main__":
+    main()
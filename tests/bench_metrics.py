@@ -0,0 +1,76 @@
+# Copyright (c) 2019 Ben Maddison. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""Benchmark of the cost of the listener request metrics.
+
+The cost of a single RequestMetrics.record() call is measured, then the
+time per request of the cheapest route through the in-process WSGI path,
+with and without the request metrics:
+
+    python tests/bench_metrics.py --requests 20000
+"""
+
+from __future__ import print_function
+
+import argparse
+import shutil
+import tempfile
+import time
+
+from helpers import synthetic_vrps
+
+from rpki_agent.handoff import Handoff
+from rpki_agent.listener import RpkiHttpServer
+from rpki_agent.metrics import RequestMetrics
+from rpki_agent.worker import RpkiWorker
+
+
+def per_call(func, count):
+    """Get the time per call of 'func', in microseconds."""
+    start = time.time()
+    for _ in range(count):
+        func()
+    return (time.time() - start) / count * 1e6
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+    metrics = RequestMetrics(["covered", "policy"], slots=4)
+    print("record(): {:.1f}us".format(
+        per_call(lambda: metrics.record("covered", 200, 1000, 0.002),
+                 args.requests * 10)))
+    data_dir = tempfile.mkdtemp()
+    try:
+        (_, listener) = Handoff.pair()
+        server = RpkiHttpServer(conn=listener, mode="shared",
+                                data_dir=data_dir)
+        server.register()
+        server.publish(RpkiWorker([], data_dir)
+                       .process(synthetic_vrps(1000))[1])
+        client = server.app.test_client()
+        origin = sorted(server.current().store.origins("ipv4"))[0]
+        path = "/as-paths/{}".format(origin)
+        requests = server.requests
+        for label, metrics in (("without metrics", None),
+                               ("with metrics", requests)):
+            server.requests = metrics
+            print("{}: {:.1f}us per request".format(
+                label, per_call(lambda: client.get(path).data,
+                                args.requests)))
+    finally:
+        shutil.rmtree(data_dir)
+
+
+if __name__ == "__main__":
+    main()
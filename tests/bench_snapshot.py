@@ -0,0 +1,101 @@
+# Copyright (c) 2019 Ben Maddison. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""Benchmark of handing a VRP set to another process.
+
+A synthetic VRP set is handed to a child process, either pickled over a
+multiprocessing.Pipe, or written to a VRPSnapshot file that the child
+maps and loads into a VRPSet. The time until the child holds the set is
+reported for each, along with the snapshot file size:
+
+    python tests/bench_snapshot.py --vrps 500000 --runs 3
+"""
+
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from helpers import synthetic_vrps
+
+from rpki_agent.snapshot import VRPSnapshot
+
+
+def receive_pickled(conn, done):
+    """Receive a VRPSet over a pipe."""
+    vrps = conn.recv()
+    done.send((time.time(), len(vrps)))
+
+
+def load_snapshot(path, done):
+    """Map a snapshot file and load it into a VRPSet."""
+    with VRPSnapshot(path) as snapshot:
+        vrps = snapshot.vrps()
+    done.send((time.time(), len(vrps)))
+
+
+def pickled(vrps):
+    """Hand 'vrps' over a pipe, and return (seconds, count)."""
+    (p_data, c_data) = multiprocessing.Pipe()
+    (p_done, c_done) = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=receive_pickled,
+                                   args=(c_data, c_done))
+    proc.start()
+    start = time.time()
+    p_data.send(vrps)
+    (end, count) = p_done.recv()
+    proc.join()
+    return (end - start, count)
+
+
+def snapshot(vrps, directory):
+    """Hand 'vrps' as a snapshot file, and return the timings and size."""
+    (p_done, c_done) = multiprocessing.Pipe()
+    path = os.path.join(directory, "vrps.bin")
+    start = time.time()
+    VRPSnapshot.write(path, vrps, 1)
+    written = time.time()
+    proc = multiprocessing.Process(target=load_snapshot,
+                                   args=(path, c_done))
+    proc.start()
+    (end, count) = p_done.recv()
+    proc.join()
+    return (written - start, end - written, count, os.path.getsize(path))
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vrps", type=int, default=500000)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+    vrps = synthetic_vrps(args.vrps)
+    directory = tempfile.mkdtemp()
+    try:
+        for run in range(args.runs):
+            (seconds, count) = pickled(vrps)
+            assert count == len(vrps)
+            print("run {}: pickled over pipe {:.2f}s".format(run, seconds))
+            (write, load, count, size) = snapshot(vrps, directory)
+            assert count == len(vrps)
+            print("run {}: snapshot write {:.2f}s + load {:.2f}s = {:.2f}s "
+                  "({:.1f} MiB)".format(run, write, load, write + load,
+                                        size / 1048576.0))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+# Copyright (c) 2019 Ben Maddison. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""Benchmark of the oneshot and persistent worker modes.
+
+A local HTTP server stands in for a validation cache, serving an export
+of a synthetic VRP set, with one VRP changed before each cycle. A number
+of cycles is run with a new worker process for each, then with one
+persistent worker. The time of each cycle, from dispatch until its
+result is received, the worker overhead reported by the worker, and the
+number of TCP connections accepted by the cache are reported:
+
+    python tests/bench_worker.py --vrps 100000 --cycles 5
+
+There is no eAPI endpoint, so the workers do not connect to one.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import shutil
+import tempfile
+import threading
+import time
+
+from helpers import synthetic_vrps
+
+from rpki_agent.worker import RpkiWorker
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+class Cache(ThreadingMixIn, HTTPServer):
+    """A local validation cache, counting the connections it accepts."""
+
+    daemon_threads = True
+
+    def __init__(self, vrps):
+        """Start serving an export of 'vrps'."""
+        HTTPServer.__init__(self, ("127.0.0.1", 0), Handler)
+        self.roas = [{"asn": vrp.asn, "prefix": vrp.prefix,
+                      "maxLength": vrp.maxLength, "ta": vrp.ta}
+                     for vrp in vrps]
+        self.connections = 0
+        self.change()
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        """Get the URL of the export."""
+        return "http://127.0.0.1:{}/".format(self.server_address[1])
+
+    def change(self):
+        """Change the origin of one VRP, and re-generate the export."""
+        roa = self.roas[len(self.roas) // 2]
+        roa["asn"] = "AS{}".format(int(roa["asn"][2:]) + 1)
+        self.export = json.dumps(
+            {"metadata": {"generated": int(time.time())}, "roas": self.roas},
+            sort_keys=True).encode("utf-8")
+
+    def get_request(self):
+        """Accept a connection, and count it."""
+        self.connections += 1
+        return HTTPServer.get_request(self)
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Answer requests with the current export of the cache."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        """Handle a GET request."""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(self.server.export)))
+        self.end_headers()
+        self.wfile.write(self.server.export)
+
+    def log_message(self, *args):
+        """Do not log requests."""
+
+
+def oneshot(cache, data_dir, cycles):
+    """Run 'cycles' cycles, with a new worker for each."""
+    results = list()
+    (validators, snapshot) = (None, None)
+    for _ in range(cycles):
+        cache.change()
+        start = time.time()
+        worker = RpkiWorker([cache.url], data_dir, validators=validators,
+                            previous=snapshot)
+        worker.start()
+        (stats, snapshot, validators) = worker.p_data.recv()
+        results.append((time.time() - start, stats["worker_overhead_ms"]))
+        worker.join()
+    return results
+
+
+def persistent(cache, data_dir, cycles):
+    """Run 'cycles' cycles in one persistent worker."""
+    results = list()
+    cache.change()
+    start = time.time()
+    worker = RpkiWorker([cache.url], data_dir, persistent=True)
+    worker.start()
+    (stats, snapshot, validators) = worker.p_data.recv()
+    results.append((time.time() - start, stats["worker_overhead_ms"]))
+    for _ in range(cycles - 1):
+        cache.change()
+        start = time.time()
+        worker.p_data.send(("refresh", start, validators, snapshot))
+        (stats, snapshot, validators) = worker.p_data.recv()
+        results.append((time.time() - start, stats["worker_overhead_ms"]))
+    # the agent terminates a persistent worker that it no longer needs
+    worker.terminate()
+    worker.join()
+    return results
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vrps", type=int, default=100000)
+    parser.add_argument("--cycles", type=int, default=5)
+    args = parser.parse_args()
+    RpkiWorker.connect_eapi = lambda self: None
+    vrps = synthetic_vrps(args.vrps)
+    for mode in (oneshot, persistent):
+        cache = Cache(vrps)
+        data_dir = tempfile.mkdtemp()
+        try:
+            results = mode(cache, data_dir, args.cycles)
+        finally:
+            cache.shutdown()
+            cache.server_close()
+            shutil.rmtree(data_dir)
+        print("{}: {:.2f}-{:.2f}s per cycle, {}-{}ms overhead, "
+              "{} TCP connections"
+              .format(mode.__name__, min(s for s, _ in results),
+                      max(s for s, _ in results),
+                      min(o for _, o in results), max(o for _, o in results),
+                      cache.connections))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# Copyright (c) 2019 Ben Maddison. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""rpki_agent test fixtures."""
+
+from __future__ import print_function
+
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+import helpers
+
+try:
+    import eossdk  # noqa
+except ImportError:
+    # the EOS SDK is only available on a switch: provide enough of it for
+    # the modules under test to be imported
+    eossdk = types.ModuleType("eossdk")
+
+    def _handler(name):
+        return type(name, (object,), {"__init__": lambda self, *a: None})
+
+    class _Tracer(object):
+        def __init__(self, name):
+            self.name = name
+
+        def trace(self, level, msg):
+            pass
+
+    for name in ("AgentHandler", "TimeoutHandler", "FdHandler"):
+        setattr(eossdk, name, _handler(name))
+    eossdk.Tracer = _Tracer
+    eossdk.now = time.time
+    sys.modules["eossdk"] = eossdk
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """Answer each GET request with the function given to http_server."""
+
+    protocol_version = "HTTP/1.0"
+
+    def do_GET(self):
+        """Handle a GET request."""
+        self.server.respond(self)
+
+    def log_message(self, *args):
+        """Do not log requests."""
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    """A threaded local HTTP server."""
+
+    daemon_threads = True
+
+
+@pytest.fixture
+def http_server():
+    """Start local HTTP servers as stand-ins for validation caches.
+
+    The fixture is a function that starts a server which answers each
+    request by calling 'respond' with the request handler, and returns
+    its URL.
+    """
+    servers = list()
+
+    def serve(respond):
+        server = _Server(("127.0.0.1", 0), _RequestHandler)
+        server.respond = respond
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        servers.append(server)
+        return "http://127.0.0.1:{}/".format(server.server_address[1])
+
+    yield serve
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def synthetic_vrps():
+    """Get the synthetic VRP set generator of the helpers module."""
+    return helpers.synthetic_vrps
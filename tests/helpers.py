@@ -0,0 +1,43 @@
+# Copyright (c) 2019 Ben Maddison. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""rpki_agent test and benchmark helpers."""
+
+from __future__ import print_function
+
+import random
+
+import ipaddress
+
+
+def synthetic_vrps(count, seed=0):
+    """Generate a random VRPSet of 'count' IPv4 and IPv6 VRPs.
+
+    One in five VRPs is IPv6. Origins are drawn from 'count' / 10 ASNs,
+    so that most origins have several VRPs.
+    """
+    from rpki_agent.vrp import VRP, VRPSet
+    rand = random.Random(seed)
+    vrps = list()
+    for i in range(count):
+        if i % 5:
+            (width, length) = (32, rand.randint(8, 24))
+            address = ipaddress.IPv4Address
+        else:
+            (width, length) = (128, rand.randint(19, 48))
+            address = ipaddress.IPv6Address
+        bits = rand.getrandbits(length) << (width - length)
+        prefix = u"{}/{}".format(address(bits), length)
+        asn = "AS{}".format(rand.randint(1, max(1, count // 10)))
+        vrps.append(VRP(asn=asn, prefix=prefix,
+                        maxLength=min(width, length + rand.randint(0, 4)),
+                        ta=u"test"))
+    return VRPSet(vrps)
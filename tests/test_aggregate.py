@@ -0,0 +1,115 @@
+# Copyright (c) 2019 Ben Maddison. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""Tests for rpki_agent.aggregate."""
+
+from __future__ import print_function
+
+from hypothesis import given, settings, strategies
+
+from rpki_agent.aggregate import aggregate
+from rpki_agent.vrp import VRP, VRPSet
+
+
+def networks(width, min_length=0, prefix=0, prefix_length=0):
+    """Build a strategy for lists of (address, length) pairs.
+
+    Every network is within 'prefix'/'prefix_length', so that a narrow
+    prefix gives densely clustered, overlapping and adjacent networks.
+    """
+    host = width - prefix_length
+    return strategies.lists(strategies.tuples(
+        strategies.integers(0, (1 << host) - 1).map(lambda a: prefix | a),
+        strategies.integers(max(min_length, prefix_length), width)))
+
+
+def reference(networks, width):
+    """Aggregate 'networks' by repeatedly merging prefixes.
+
+    Covered prefixes are dropped, and pairs of sibling prefixes are
+    replaced by their parent, until neither is possible.
+    """
+    prefixes = {(address >> (width - length) << (width - length), length)
+                for address, length in networks}
+    changed = True
+    while changed:
+        changed = False
+        for address, length in sorted(prefixes):
+            covered = any((address >> (width - shorter) <<
+                           (width - shorter), shorter) in prefixes
+                          for shorter in range(length))
+            sibling = (address ^ (1 << (width - length)), length)
+            if covered:
+                prefixes.discard((address, length))
+            elif length and sibling in prefixes:
+                prefixes -= {(address, length), sibling}
+                prefixes.add((min(address, sibling[0]), length - 1))
+            else:
+                continue
+            changed = True
+            break
+    return sorted(prefixes)
+
+
+@settings(max_examples=500)
+@given(networks(32))
+def test_ipv4(networks):
+    """Aggregate random IPv4 networks."""
+    assert aggregate(networks, 32) == reference(networks, 32)
+
+
+@settings(max_examples=500)
+@given(networks(128, min_length=16))
+def test_ipv6(networks):
+    """Aggregate random IPv6 networks."""
+    assert aggregate(networks, 128) == reference(networks, 128)
+
+
+@settings(max_examples=500)
+@given(networks(32, prefix=0x0a000000, prefix_length=22))
+def test_clustered(networks):
+    """Aggregate densely clustered IPv4 networks."""
+    assert aggregate(networks, 32) == reference(networks, 32)
+
+
+def test_expected():
+    """Aggregate a hand-computed set of IPv4 networks."""
+    networks = [(0x0a000000, 24), (0x0a000100, 24),    # 10.0.0.0/23
+                (0x0a000200, 23), (0x0a000280, 25),    # 10.0.2.0/23
+                (0x0a000400, 24),                      # 10.0.4.0/24
+                (0x0a000600, 24),                      # not adjacent
+                (0xc0000200, 25), (0xc0000280, 26),    # 192.0.2.0/25 + /26
+                (0xcb007100, 32)]
+    assert aggregate(networks, 32) == [(0x0a000000, 22), (0x0a000400, 24),
+                                       (0x0a000600, 24), (0xc0000200, 25),
+                                       (0xc0000280, 26), (0xcb007100, 32)]
+    assert aggregate([(0, 1), (1 << 31, 1)], 32) == [(0, 0)]
+    assert aggregate([], 32) == []
+
+
+def test_host_bits():
+    """Ignore host bits set in an address."""
+    assert aggregate([(0x0a000001, 24), (0x0a0001ff, 24)], 32) == \
+        [(0x0a000000, 23)]
+
+
+def test_covered():
+    """Aggregate the prefixes of a VRP set into pseudo VRPs."""
+    vrps = VRPSet([VRP(asn="AS65000", prefix=u"192.0.2.0/25",
+                       maxLength=25, ta=u"test"),
+                   VRP(asn="AS65001", prefix=u"192.0.2.128/25",
+                       maxLength=26, ta=u"test"),
+                   VRP(asn="AS65001", prefix=u"2001:db8::/32",
+                       maxLength=48, ta=u"test")])
+    assert [(vrp.prefix, vrp.maxLength)
+            for vrp in vrps.covered("ipv4")] == [(u"192.0.2.0/24", 32)]
+    assert [(vrp.prefix, vrp.maxLength)
+            for vrp in vrps.covered("ipv6")] == [(u"2001:db8::/32", 128)]
@@ -0,0 +1,114 @@
+# Copyright (c) 2019 Ben Maddison. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""Tests for rpki_agent.export."""
+
+from __future__ import print_function
+
+import json
+import random
+
+import pytest
+import requests
+
+from rpki_agent.export import export_time, ExportStream
+from rpki_agent.metrics import peak_rss, reset_peak_rss
+
+export = {"metadata": {"generated": 1.5e9, "counts": [-12.75, 1.5e3, 0]},
+          "roas": [{"asn": "AS{}".format(i),
+                    "prefix": "10.0.{}.0/24".format(i),
+                    "maxLength": 24, "weight": -1.25e2}
+                   for i in range(20)],
+          "float": -12.75, "exponent": 1.5e3, "integer": 7}
+data = json.dumps(export, sort_keys=True).encode("utf-8")
+
+
+def check(chunks):
+    """Check that an ExportStream of 'chunks' decodes 'export'."""
+    stream = ExportStream(chunks)
+    assert list(stream) == export["roas"]
+    assert stream.metadata == {key: value for key, value in export.items()
+                               if key != "roas"}
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 8, 13, 64, len(data)])
+def test_chunk_sizes(size):
+    """Decode an export split into chunks of a fixed size."""
+    check(data[i:i + size] for i in range(0, len(data), size))
+
+
+def test_random_chunks():
+    """Decode an export split at random offsets."""
+    rand = random.Random(0)
+    for _ in range(500):
+        cuts = sorted(rand.sample(range(1, len(data)), rand.randint(1, 40)))
+        check(data[start:end]
+              for start, end in zip([0] + cuts, cuts + [len(data)]))
+
+
+def test_export_time():
+    """Get the generation time from the export metadata."""
+    stream = ExportStream([data])
+    list(stream)
+    assert export_time(stream.metadata) == 1.5e9
+    assert export_time({"metadata": {"buildtime":
+                                     "2019-01-01T00:00:00Z"}}) == 1546300800
+
+
+def test_malformed():
+    """Reject malformed input without reading the rest of the stream."""
+    consumed = [0]
+
+    def chunks():
+        yield b'{"roas": [{"asn": "AS1", "prefix": ]'
+        while True:
+            consumed[0] += 1
+            yield b"[" * 1024
+
+    stream = ExportStream(chunks())
+    stream.max_value_size = 64 * 1024
+    with pytest.raises(ValueError):
+        list(stream)
+    assert consumed[0] <= 2 * stream.max_value_size // 1024
+
+
+def test_truncated():
+    """Reject an export that ends early."""
+    with pytest.raises(ValueError):
+        list(ExportStream([data[:len(data) // 2]]))
+
+
+def test_http_memory(http_server):
+    """Stream a large export from a local cache in bounded memory."""
+    count = 200000
+    entry = ('{{"asn": "AS{0}", "prefix": "10.{1}.{2}.0/24", '
+             '"maxLength": 24, "ta": "ripe"}}')
+
+    def respond(handler):
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/json")
+        handler.end_headers()
+        handler.wfile.write(b'{"metadata": {"generated": 1}, "roas": [')
+        for i in range(count):
+            handler.wfile.write(
+                ((", " if i else "") +
+                 entry.format(i, i // 256 % 256, i % 256)).encode("utf-8"))
+        handler.wfile.write(b"]}")
+
+    url = http_server(respond)
+    resp = requests.get(url, stream=True)
+    stream = ExportStream(resp.iter_content(chunk_size=64 * 1024))
+    reset_peak_rss()
+    before = peak_rss()
+    # the export is about 15MiB of text
+    assert sum(1 for _ in stream) == count
+    assert peak_rss() - before < 8 * 1024
+    assert stream.metadata == {"metadata": {"generated": 1}}
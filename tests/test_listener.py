@@ -0,0 +1,243 @@
+# Copyright (c) 2019 Ben Maddison. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""Tests for rpki_agent.listener."""
+
+from __future__ import print_function
+
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+import pytest
+
+from rpki_agent.handoff import Handoff
+from rpki_agent.listener import RpkiHttpServer
+from rpki_agent.metrics import metrics_name, write_metrics
+from rpki_agent.store import BodyStore
+from rpki_agent.worker import RpkiWorker
+
+
+@pytest.fixture
+def vrps(synthetic_vrps):
+    """Generate a VRP set."""
+    return synthetic_vrps(1000)
+
+
+@pytest.fixture
+def server(tmpdir, vrps):
+    """Create a shared mode server, with a processed snapshot published."""
+    (agent, listener) = Handoff.pair()
+    server = RpkiHttpServer(conn=listener, mode="shared",
+                            data_dir=str(tmpdir))
+    server.register()
+    server.worker = RpkiWorker([], str(tmpdir))
+    server.publish(server.worker.process(vrps)[1])
+    yield server
+    agent.close()
+    listener.close()
+
+
+@pytest.fixture
+def client(server):
+    """Get a test client of the server application."""
+    return server.app.test_client()
+
+
+def test_covered(client, vrps):
+    """Serve the covered prefix-lists, with validators."""
+    resp = client.get("/prefix-lists/ipv4/covered")
+    assert resp.status_code == 200
+    assert len(resp.data.splitlines()) == len(vrps.covered("ipv4"))
+    etag = resp.headers["ETag"]
+    resp = client.get("/prefix-lists/ipv4/covered",
+                      headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    resp = client.get("/prefix-lists/ipv4/covered",
+                      headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert resp.headers["ETag"] != etag
+    assert client.get("/prefix-lists/ipv5/covered").status_code == 404
+
+
+def test_for_origin(client, vrps):
+    """Serve the prefix-list and as-path access-list of an origin."""
+    origin = sorted(vrps.origins("ipv4"))[0]
+    resp = client.get("/prefix-lists/ipv4/origin/{}".format(origin))
+    assert resp.status_code == 200
+    assert len(resp.data.splitlines()) == \
+        len(vrps.for_origin(origin, "ipv4"))
+    resp = client.get("/as-paths/{}".format(origin))
+    assert resp.data == "permit _{}$ any\n".format(origin).encode("utf-8")
+    assert client.get("/prefix-lists/ipv4/origin/4200000000") \
+        .status_code == 404
+    assert client.get("/as-paths/4200000000").status_code == 404
+
+
+def test_policy(client, vrps):
+    """Stream the per-origin config objects of an afi."""
+    origins = sorted(vrps.origins("ipv4"), key=int)
+    resp = client.get("/policy/ipv4")
+    assert resp.status_code == 200
+    text = resp.data.decode("utf-8")
+    assert text.count("ip prefix-list RPKI-AS") == len(origins)
+    resp = client.post("/policy/ipv4",
+                       data="AS{} {}".format(origins[0], origins[1]))
+    text = resp.data.decode("utf-8")
+    assert text.count("ip prefix-list RPKI-AS") == 2
+    resp = client.get("/policy/ipv4", headers={
+        "If-Modified-Since": resp.headers["Last-Modified"]})
+    assert resp.status_code == 304
+    assert client.get("/policy/ipv4?origin=ASx").status_code == 400
+
+
+def test_refresh(server, client):
+    """Reject refresh triggers when there is no trigger channel."""
+    assert client.post("/refresh").status_code == 404
+
+
+def test_not_published(tmpdir):
+    """Serve nothing until a snapshot is published."""
+    (agent, listener) = Handoff.pair()
+    server = RpkiHttpServer(conn=listener, mode="shared",
+                            data_dir=str(tmpdir))
+    server.register()
+    resp = server.app.test_client().get("/prefix-lists/ipv4/covered")
+    assert resp.status_code == 404
+    assert "X-RPKI-Generation" not in resp.headers
+
+
+def test_republish(server, client, vrps):
+    """Serve the current snapshot until a newly published one is mapped."""
+    previous = server.current()
+    assert previous.index.generation == previous.generation
+    server.worker.previous = None
+    server.publish(server.worker.process(vrps)[1])
+    # the new snapshot is mapped, and indexed, in the background
+    resp = client.get("/validate?prefix=192.0.2.0/24&origin=AS1")
+    assert resp.status_code == 200
+    assert resp.headers["X-RPKI-Generation"] == str(previous.generation)
+    assert resp.get_json()["generation"] == previous.generation
+    with server.mapping:
+        pass
+    assert server.mapped.generation > previous.generation
+    assert server.mapped.index.generation == server.mapped.generation
+    resp = client.get("/validate?prefix=192.0.2.0/24&origin=AS1")
+    assert resp.headers["X-RPKI-Generation"] == \
+        str(server.mapped.generation)
+
+
+def test_concurrent_publish(server, synthetic_vrps):
+    """Serve each request entirely from one generation during publishes."""
+    server.stream_chunk_size = 256
+    expected = dict()
+    responses = list()
+    done = threading.Event()
+
+    def request():
+        client = server.app.test_client()
+        while not done.is_set():
+            for path in ("/prefix-lists/ipv4/covered", "/policy/ipv4",
+                         "/validate?prefix=192.0.2.0/24&origin=AS1"):
+                resp = client.get(path)
+                responses.append((path, resp.headers["X-RPKI-Generation"],
+                                  resp.data))
+
+    threads = [threading.Thread(target=request) for _ in range(4)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for seed in range(1, 6):
+            server.worker.previous = None
+            snapshot = server.worker.process(synthetic_vrps(1000, seed))[1]
+            with BodyStore(snapshot.bodies) as store:
+                expected[str(snapshot.generation)] = store.get("ipv4").data
+            server.publish(snapshot)
+            time.sleep(0.2)
+    finally:
+        done.set()
+        for thread in threads:
+            thread.join(5)
+    bodies = dict()
+    generations = set()
+    for path, generation, data in responses:
+        generations.add(generation)
+        if path.startswith("/validate"):
+            assert str(json.loads(data.decode("utf-8"))["generation"]) == \
+                generation
+        elif path.endswith("/covered") and generation in expected:
+            assert data == expected[generation]
+        # every response of a generation has the same body
+        assert bodies.setdefault((path, generation), data) == data
+    assert len(generations) > 2
+
+
+class Worker(object):
+    """A stand-in for a gunicorn worker."""
+
+
+def test_metrics(server, client):
+    """Serve the agent stats, and the request counters of every worker."""
+    write_metrics(os.path.join(server.data_dir, metrics_name),
+                  {"stage_fetch_ms": 1500, "vrps_total": 1000})
+    arbiter = Worker()
+    arbiter.WORKERS = dict()
+    # each worker about to be forked is assigned a free slot
+    for pid in range(3):
+        worker = Worker()
+        server.assign_slot(arbiter, worker)
+        client.get("/prefix-lists/ipv4/covered")
+        arbiter.WORKERS[pid] = worker
+    assert sorted(w.metrics_slot for w in arbiter.WORKERS.values()) == \
+        [0, 1, 2]
+    # a slot is re-used once its worker has exited
+    del arbiter.WORKERS[1]
+    server.assign_slot(arbiter, Worker())
+    assert server.requests.slot == 1
+    client.get("/prefix-lists/ipv5/covered")
+    text = client.get("/metrics").data.decode("utf-8")
+    lines = text.splitlines()
+    assert 'rpki_agent_stage_duration_seconds{stage="fetch"} 1.5' in lines
+    assert "rpki_agent_vrps_total 1000" in lines
+    assert "rpki_agent_listener_serving_generation {}".format(
+        server.mapped.generation) in lines
+    assert 'rpki_agent_http_requests_total{route="covered",code="2xx"} 3' \
+        in lines
+    assert 'rpki_agent_http_requests_total{route="covered",code="4xx"} 1' \
+        in lines
+
+
+def test_watcher(tmpdir, synthetic_vrps):
+    """Publish each snapshot received by the watcher process."""
+    (agent, listener) = Handoff.pair()
+    server = RpkiHttpServer(conn=listener, mode="shared",
+                            data_dir=str(tmpdir))
+    watcher = multiprocessing.Process(target=server.watch)
+    watcher.start()
+    try:
+        snapshot = RpkiWorker([], str(tmpdir)).process(synthetic_vrps(100))[1]
+        agent.send_snapshot(snapshot)
+        assert agent.ready(timeout=10)
+        (kind, generation, _) = agent.recv()
+        assert (kind, generation) == (Handoff.ack, snapshot.generation)
+        assert os.readlink(server.current_path) == \
+            "current-{}".format(snapshot.generation)
+        # the server itself has mapped nothing, and has no watcher thread
+        assert server.mapped is None
+        assert threading.active_count() == 1
+    finally:
+        agent.close()
+        watcher.join(10)
+        listener.close()
+    assert watcher.exitcode == 0
@@ -0,0 +1,116 @@
+# Copyright (c) 2019 Ben Maddison. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""Tests for rpki_agent.metrics."""
+
+from __future__ import print_function
+
+import multiprocessing
+import os
+import signal
+
+from rpki_agent.metrics import exposition, RequestMetrics, Spans
+
+
+def samples(text):
+    """Parse an exposition into {name and labels: value}."""
+    return {line.rsplit(" ", 1)[0]: float(line.rsplit(" ", 1)[1])
+            for line in text.splitlines()
+            if line and not line.startswith("#")}
+
+
+def test_exposition():
+    """Render stage spans as labelled gauges, and other stats as gauges."""
+    spans = Spans()
+    with spans.span("fetch"):
+        pass
+    stats = dict(spans.stats, vrps_total=10, cache_selected="http://x",
+                 fetched=True, covered_prefixes_ipv4=2)
+    text = exposition(stats)
+    values = samples(text)
+    assert 'rpki_agent_stage_duration_seconds{stage="fetch"}' in values
+    assert values['rpki_agent_stage_peak_rss_bytes{stage="fetch"}'] == \
+        stats["stage_fetch_peak_kb"] * 1024
+    assert values["rpki_agent_vrps_total"] == 10
+    assert values["rpki_agent_covered_prefixes_ipv4"] == 2
+    assert "cache_selected" not in text
+    assert "fetched" not in text
+    assert "# TYPE rpki_agent_vrps_total gauge" in text.splitlines()
+
+
+def record(metrics, slot, count):
+    """Record 'count' responses in a slot, as a forked worker would."""
+    metrics.slot = slot
+    for _ in range(count):
+        metrics.record("covered", 200, 10, 0.002)
+    metrics.record("unknown", 404, 0, 20)
+
+
+def test_shared():
+    """Report the totals of the responses recorded by every process."""
+    metrics = RequestMetrics(["covered", "policy"], slots=3)
+    workers = [multiprocessing.Process(target=record,
+                                       args=(metrics, slot, 1000))
+               for slot in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(10)
+        assert worker.exitcode == 0
+    values = samples(metrics.exposition())
+    label = 'route="covered"'
+    assert values['rpki_agent_http_requests_total{{{},code="2xx"}}'
+                  .format(label)] == 3000
+    assert values["rpki_agent_http_response_bytes_total{{{}}}"
+                  .format(label)] == 30000
+    assert values['rpki_agent_http_request_duration_seconds_bucket'
+                  '{{{},le="0.001"}}'.format(label)] == 0
+    assert values['rpki_agent_http_request_duration_seconds_bucket'
+                  '{{{},le="0.0025"}}'.format(label)] == 3000
+    assert values["rpki_agent_http_request_duration_seconds_sum{{{}}}"
+                  .format(label)] == 6
+    assert values['rpki_agent_http_requests_total'
+                  '{route="other",code="4xx"}'] == 3
+    assert values['rpki_agent_http_request_duration_seconds_bucket'
+                  '{route="other",le="+Inf"}'] == 3
+    assert values['rpki_agent_http_requests_total'
+                  '{route="policy",code="2xx"}'] == 0
+
+
+def killed(metrics):
+    """Die while recording a response."""
+    metrics.slot = 0
+    metrics.lock.acquire()
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def test_killed():
+    """Keep recording in other workers after one is killed mid-record."""
+    metrics = RequestMetrics(["covered"], slots=2)
+    worker = multiprocessing.Process(target=killed, args=(metrics,))
+    worker.start()
+    worker.join(10)
+    assert worker.exitcode == -signal.SIGKILL
+    worker = multiprocessing.Process(target=record, args=(metrics, 1, 10))
+    worker.start()
+    worker.join(10)
+    assert worker.exitcode == 0
+    values = samples(metrics.exposition())
+    assert values['rpki_agent_http_requests_total'
+                  '{route="covered",code="2xx"}'] == 10
+
+
+def test_free_slot():
+    """Assign each live worker a slot of its own, while there are enough."""
+    metrics = RequestMetrics(["covered"], slots=3)
+    assert metrics.free_slot([]) == 0
+    assert metrics.free_slot([0, None, 2]) == 1
+    assert metrics.free_slot([0, 1, 2]) in (0, 1, 2)
@@ -0,0 +1,123 @@
+# Copyright (c) 2019 Ben Maddison. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""Tests for rpki_agent.push."""
+
+from __future__ import print_function
+
+import json
+import os
+
+import pytest
+
+from rpki_agent.push import EapiPush
+from rpki_agent.store import BodyStore
+from rpki_agent.vrp import VRPSet
+from rpki_agent.worker import RpkiWorker
+
+
+class Node(object):
+    """A stand-in for a pyeapi Node, recording the commands it is sent."""
+
+    def __init__(self, fail=None):
+        """Initialise a Node, failing any batch containing 'fail'."""
+        self.batches = list()
+        self.fail = fail
+
+    def run_commands(self, commands):
+        """Record a batch of commands."""
+        self.batches.append(list(commands))
+        if self.fail is not None and self.fail in commands:
+            raise RuntimeError("CLI command failed")
+        return [{} for _ in commands]
+
+
+@pytest.fixture
+def snapshots(tmpdir, synthetic_vrps):
+    """Process a VRP set, then a change to the VRPs of one origin."""
+    vrps = synthetic_vrps(500)
+    worker = RpkiWorker([], str(tmpdir))
+    snapshot = worker.process(vrps)[1]
+    origin = sorted(vrps.origins("ipv4"))[0]
+    worker.previous = snapshot
+    changed = VRPSet(vrp for vrp in vrps if vrp.as_number != origin)
+    update = worker.process(changed)[1]
+    return (snapshot, update, origin)
+
+
+def state(data_dir):
+    """Load the record of the objects last pushed."""
+    with open(os.path.join(data_dir, EapiPush.state_name)) as f:
+        return json.load(f)
+
+
+def update_origins(snapshot):
+    """Get the IPv4 origins of a snapshot."""
+    with BodyStore(snapshot.bodies) as store:
+        return set(store.origins("ipv4"))
+
+
+def test_push(tmpdir, snapshots):
+    """Push every object in batches, then only the changed objects."""
+    (snapshot, update, origin) = snapshots
+    node = Node()
+    pusher = EapiPush(node, str(tmpdir))
+    pusher.batch_size = 100
+    stats = pusher.push(snapshot)
+    enter = "configure session rpki-agent-{}".format(snapshot.generation)
+    assert stats["eapi_push_result"] == "ok"
+    assert stats["eapi_batches"] == len(node.batches) > 1
+    assert stats["eapi_objects_removed"] == 0
+    for batch in node.batches:
+        assert batch[0] == enter
+        assert len(batch) <= pusher.batch_size + 2
+    assert [batch[-1] for batch in node.batches].count("commit") == 1
+    assert node.batches[-1][-1] == "commit"
+    pushed = state(str(tmpdir))
+    assert pushed["generation"] == snapshot.generation
+    assert stats["eapi_objects_changed"] == len(pushed["objects"])
+    assert "RPKI-COVERED-V4" in pushed["objects"]
+    assert "RPKI-AS{}-V4".format(origin) in pushed["objects"]
+
+    # the same snapshot is not pushed again
+    node.batches = list()
+    assert pusher.push(snapshot) == {"eapi_push_result": "unchanged"}
+    assert node.batches == []
+
+    # only the objects affected by a change are pushed
+    node.batches = list()
+    stats = pusher.push(update)
+    commands = [command for batch in node.batches for command in batch]
+    assert stats["eapi_batches"] == len(node.batches)
+    assert "no ip prefix-list RPKI-AS{}-V4".format(origin) in commands
+    assert "ip prefix-list RPKI-COVERED-V4" in commands
+    unchanged = "RPKI-AS{}-V4".format(sorted(update_origins(update))[0])
+    assert not any(unchanged in command for command in commands)
+    pushed = state(str(tmpdir))
+    assert pushed["generation"] == update.generation
+    assert "RPKI-AS{}-V4".format(origin) not in pushed["objects"]
+    assert unchanged in pushed["objects"]
+
+
+def test_abort(tmpdir, snapshots):
+    """Abort the session, and keep the previous state, on an error."""
+    (snapshot, _, _) = snapshots
+    node = Node(fail="ipv6 prefix-list RPKI-COVERED-V6")
+    pusher = EapiPush(node, str(tmpdir))
+    pusher.batch_size = 100
+    with pytest.raises(RuntimeError):
+        pusher.push(snapshot)
+    enter = "configure session rpki-agent-{}".format(snapshot.generation)
+    # no batch is sent after the failed one, other than the abort
+    assert node.fail in node.batches[-2]
+    assert node.batches[-1] == [enter, "abort"]
+    assert not os.path.exists(os.path.join(str(tmpdir),
+                                           EapiPush.state_name))
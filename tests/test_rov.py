@@ -0,0 +1,66 @@
+# Copyright (c) 2019 Ben Maddison. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""Tests for rpki_agent.rov."""
+
+from __future__ import print_function
+
+import pytest
+
+from rpki_agent.rov import RovIndex
+from rpki_agent.vrp import VRP
+
+
+@pytest.fixture
+def index():
+    """Build an index of a few IPv4 and IPv6 VRPs."""
+    vrps = [VRP(asn="AS65000", prefix=u"192.0.2.0/24", maxLength=25,
+                ta=u"test"),
+            VRP(asn="AS65001", prefix=u"192.0.2.0/25", maxLength=25,
+                ta=u"test"),
+            VRP(asn="AS0", prefix=u"198.51.100.0/24", maxLength=32,
+                ta=u"test"),
+            VRP(asn="AS65000", prefix=u"2001:db8::/32", maxLength=48,
+                ta=u"test")]
+    return RovIndex((vrp.parsed for vrp in vrps), generation=1)
+
+
+@pytest.mark.parametrize("prefix, origin, state", [
+    ("192.0.2.0/24", "AS65000", "valid"),
+    ("192.0.2.128/25", "65000", "valid"),
+    ("192.0.2.0/25", "as65001", "valid"),
+    ("192.0.2.0/26", "AS65000", "invalid"),
+    ("192.0.2.0/24", "AS65001", "invalid"),
+    ("198.51.100.0/24", "AS0", "invalid"),
+    ("203.0.113.0/24", "AS65000", "not-found"),
+    ("2001:db8:1::/48", "AS65000", "valid"),
+    ("2001:db8::/29", "AS65000", "not-found"),
+])
+def test_validate(index, prefix, origin, state):
+    """Validate routes as described in RFC 6811."""
+    assert index.count == 4
+    assert index.validate(prefix, origin) == state
+
+
+@pytest.mark.parametrize("origin", ["AS", "ASAS65000", "SA65000", "AS-1",
+                                    "4294967296", "x"])
+def test_invalid_origin(origin):
+    """Reject anything but an AS number with an optional 'AS' prefix."""
+    with pytest.raises(ValueError):
+        RovIndex.parse_origin(origin)
+
+
+@pytest.mark.parametrize("prefix", ["192.0.2.0", "192.0.2.0/33",
+                                    "2001:db8::/129", "x/24", None])
+def test_invalid_prefix(prefix):
+    """Reject anything but a prefix in CIDR notation."""
+    with pytest.raises(ValueError):
+        RovIndex.parse_prefix(prefix)
@@ -0,0 +1,258 @@
+# Copyright (c) 2019 Ben Maddison. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""Tests for rpki_agent.rtr."""
+
+from __future__ import print_function
+
+import socket
+import struct
+import threading
+
+import pytest
+
+from rpki_agent.rtr import RtrClient
+
+
+class RtrCache(object):
+    """A local stand-in for an RPKI to Router protocol cache.
+
+    The cache holds a set of (afi, address, length, max_length, asn)
+    tuples, and the changes leading to each serial, so that it can answer
+    both Reset and Serial Queries. A Serial Query for a serial that it no
+    longer has the changes for is answered with a Cache Reset.
+    """
+
+    header = struct.Struct("!BBHI")
+
+    def __init__(self, vrps, version=1, session_id=42):
+        """Start listening on a local port."""
+        self.version = version
+        self.session_id = session_id
+        self.serial = 1
+        self.vrps = set(vrps)
+        self.history = dict()
+        self.conns = list()
+        # a Serial Notify to send in the middle of the next response
+        self.notify_during = False
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        """Stop listening and close every connection."""
+        self.sock.close()
+        for conn in self.conns:
+            conn.close()
+
+    def pdu(self, kind, field=0, body=b""):
+        """Build a PDU."""
+        return self.header.pack(self.version, kind, field,
+                                self.header.size + len(body)) + body
+
+    def prefix(self, vrp, flags):
+        """Build an IPv4 or IPv6 Prefix PDU."""
+        (afi, address, length, max_length, asn) = vrp
+        body = struct.pack("!BBBx{}sI".format(len(address)), flags, length,
+                           max_length, address, asn)
+        return self.pdu(4 if afi == 4 else 6, 0, body)
+
+    def serial_notify(self):
+        """Build a Serial Notify PDU."""
+        return self.pdu(0, self.session_id, struct.pack("!I", self.serial))
+
+    def end_of_data(self):
+        """Build an End of Data PDU."""
+        if self.version == 0:
+            body = struct.pack("!I", self.serial)
+        else:
+            body = struct.pack("!IIII", self.serial, 3600, 600, 7200)
+        return self.pdu(7, self.session_id, body)
+
+    def accept(self):
+        """Accept connections."""
+        while True:
+            try:
+                (conn, _) = self.sock.accept()
+            except socket.error:
+                return
+            self.conns.append(conn)
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def read(self, conn, size):
+        """Read exactly 'size' bytes, or None if the connection closed."""
+        data = b""
+        while len(data) < size:
+            chunk = conn.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def handle(self, conn):
+        """Answer the queries received on a connection."""
+        try:
+            while True:
+                head = self.read(conn, self.header.size)
+                if head is None:
+                    return
+                (version, kind, _, length) = self.header.unpack(head)
+                body = self.read(conn, length - self.header.size)
+                if version != self.version:
+                    # Unsupported Protocol Version, with the erroneous PDU
+                    report = (struct.pack("!I", length) + head + body +
+                              struct.pack("!I", 0))
+                    conn.sendall(self.pdu(10, 4, report))
+                    continue
+                conn.sendall(b"".join(self.answer(kind, body)))
+        except socket.error:
+            return
+
+    def answer(self, kind, body):
+        """Get the PDUs answering a query."""
+        if kind == 2:
+            announced = [self.prefix(vrp, 1) for vrp in sorted(self.vrps)]
+            return ([self.pdu(3, self.session_id)] + announced +
+                    [self.end_of_data()])
+        (serial,) = struct.unpack("!I", body)
+        if serial != self.serial and serial + 1 not in self.history:
+            return [self.pdu(8)]
+        pdus = [self.pdu(3, self.session_id)]
+        for changed in range(serial + 1, self.serial + 1):
+            (added, removed) = self.history[changed]
+            pdus.extend(self.prefix(vrp, 1) for vrp in added)
+            pdus.extend(self.prefix(vrp, 0) for vrp in removed)
+        if self.notify_during:
+            self.notify_during = False
+            pdus.insert(1, self.serial_notify())
+        pdus.append(self.end_of_data())
+        return pdus
+
+    def change(self, added=(), removed=(), notify=True, history=True):
+        """Change the VRP set, and notify every connected client."""
+        self.serial += 1
+        if history:
+            self.history[self.serial] = (list(added), list(removed))
+        else:
+            self.history.clear()
+        self.vrps |= set(added)
+        self.vrps -= set(removed)
+        if notify:
+            for conn in self.conns:
+                conn.sendall(self.serial_notify())
+
+
+def vrp(i, asn):
+    """Build an IPv4 VRP tuple for the i'th /24 in 10.0.0.0/8."""
+    return (4, socket.inet_aton("10.{}.{}.0".format(i // 256, i % 256)),
+            24, 24, asn)
+
+
+def ipv6_vrp(i, asn):
+    """Build an IPv6 VRP tuple for the i'th /48 in 2001:db8::/32."""
+    address = socket.inet_pton(socket.AF_INET6, "2001:db8:{:x}::".format(i))
+    return (6, address, 48, 48, asn)
+
+
+def prefixes(client):
+    """Get the prefixes held by a client, as (prefix, asn) tuples."""
+    return sorted((v.prefix, v.as_number) for v in client.vrps)
+
+
+@pytest.fixture
+def cache():
+    """Start a version 1 cache with IPv4 and IPv6 VRPs."""
+    cache = RtrCache([vrp(i, 64500 + i % 3) for i in range(100)] +
+                     [ipv6_vrp(1, 64500)])
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def client(cache):
+    """Connect a client to the cache, and load the full VRP set."""
+    client = RtrClient("127.0.0.1", cache.port)
+    client.timeout = 5
+    (added, removed) = client.start()
+    assert (len(added), len(removed)) == (101, 0)
+    yield client
+    client.close()
+
+
+def test_reset(cache, client):
+    """Load the full VRP set with a Reset Query."""
+    assert client.version == 1
+    assert (client.session_id, client.serial) == (42, 1)
+    assert (client.refresh, client.retry, client.expire) == (3600, 600, 7200)
+    assert len(client.vrps) == 101
+    assert (u"2001:db8:1::/48", "64500") in prefixes(client)
+    assert client.wait(0) is False
+
+
+def test_update(cache, client):
+    """Apply an incremental update after a Serial Notify."""
+    cache.change(added=[vrp(200, 64512)], removed=[vrp(0, 64500)])
+    assert client.wait(5) is True
+    (added, removed) = client.update()
+    assert [v.prefix for v in added] == [u"10.0.200.0/24"]
+    assert [v.prefix for v in removed] == [u"10.0.0.0/24"]
+    assert client.serial == 2
+    assert len(client.vrps) == 101
+    assert client.wait(0) is False
+
+
+def test_version_fallback():
+    """Fall back to version 0 with a cache that does not support 1."""
+    cache = RtrCache([vrp(i, 64500) for i in range(10)], version=0)
+    client = RtrClient("127.0.0.1", cache.port)
+    try:
+        client.start()
+        assert client.version == 0
+        assert len(client.vrps) == 10
+        cache.change(added=[vrp(10, 64500)], notify=False)
+        client.update()
+        assert client.serial == 2
+        assert len(client.vrps) == 11
+    finally:
+        client.close()
+        cache.close()
+
+
+def test_cache_reset(cache, client):
+    """Reload the full VRP set when the cache cannot send an update."""
+    cache.change(added=[vrp(200, 64512)], removed=[vrp(0, 64500)],
+                 notify=False, history=False)
+    (added, removed) = client.update()
+    assert [v.prefix for v in added] == [u"10.0.200.0/24"]
+    assert [v.prefix for v in removed] == [u"10.0.0.0/24"]
+    assert client.serial == 2
+    assert len(client.vrps) == len(cache.vrps) == 101
+
+
+def test_notify_during_response(cache, client):
+    """Keep a Serial Notify received during a response pending."""
+    cache.change(added=[vrp(200, 64512)], notify=False)
+    cache.notify_during = True
+    client.update()
+    assert client.serial == 2
+    # the cache announced new data during the response: the client must
+    # not wait for the next notify, or the refresh interval
+    assert client.wait(0) is True
+    cache.change(added=[vrp(201, 64512)], notify=False)
+    client.update()
+    assert client.serial == 3
+    assert client.wait(0) is False
@@ -0,0 +1,183 @@
+# Copyright (c) 2019 Ben Maddison. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""Tests for rpki_agent.worker."""
+
+from __future__ import print_function
+
+import json
+import signal
+import threading
+import time
+
+import pytest
+
+from rpki_agent.store import BodyStore
+from rpki_agent.vrp import VRP, VRPSet
+from rpki_agent.worker import RpkiWorker
+
+
+def cache(generated, asn, delay=0, status=200):
+    """Get a function answering requests as a validation cache.
+
+    The export contains a single VRP originated by 'asn'. It is sent in
+    pieces over 'delay' seconds, so that the response is slow without
+    any single read timing out.
+    """
+    export = json.dumps({"metadata": {"generated": generated},
+                         "roas": [{"asn": asn, "prefix": "192.0.2.0/24",
+                                   "maxLength": 24, "ta": "test"}]},
+                        sort_keys=True)
+    pieces = 20
+
+    def respond(handler):
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.end_headers()
+        size = -(-len(export) // pieces)
+        for i in range(0, len(export), size):
+            time.sleep(float(delay) / pieces)
+            handler.wfile.write(export[i:i + size].encode("utf-8"))
+            handler.wfile.flush()
+
+    return respond
+
+
+def rendered(snapshot):
+    """Get the rendered bodies of a snapshot, as {(afi, origin): data}."""
+    with BodyStore(snapshot.bodies) as store:
+        return {(afi, origin): store.get(afi, origin).data
+                for afi, origin, _ in store.entries()}
+
+
+@pytest.mark.parametrize("processes", [1, 3])
+def test_render(tmpdir, synthetic_vrps, processes):
+    """Render a VRP set in full, then incrementally."""
+    vrps = synthetic_vrps(2000)
+    worker = RpkiWorker([], str(tmpdir), processes=processes)
+    (stats, snapshot) = worker.process(vrps)
+    bodies = rendered(snapshot)
+    assert stats["origin_asns_total"] == len(vrps.origins("ipv4") |
+                                             vrps.origins("ipv6"))
+    for afi in ("ipv4", "ipv6"):
+        assert stats["covered_prefixes_{}".format(afi)] == \
+            len(vrps.covered(afi))
+        for origin in vrps.origins(afi):
+            assert (afi, origin) in bodies
+
+    # withdraw every VRP of one origin, and add one for a new origin
+    origin = sorted(vrps.origins("ipv4"))[0]
+    changed = VRPSet(vrp for vrp in vrps if vrp.as_number != origin)
+    changed.update(VRPSet([VRP(asn="AS4200000000", prefix=u"192.0.2.0/24",
+                               maxLength=24, ta=u"test")]), VRPSet([]))
+    worker.previous = snapshot
+    (stats, update) = worker.process(changed)
+    full = RpkiWorker([], str(tmpdir.mkdir("full"))).process(changed)[1]
+    assert rendered(update) == rendered(full)
+    assert ("ipv4", origin) not in rendered(update)
+    assert ("ipv4", "4200000000") in rendered(update)
+
+
+def test_fetch_freshest(tmpdir, http_server):
+    """Use the cache with the most recently generated export."""
+    urls = [http_server(cache(1000, "AS1")), http_server(cache(2000, "AS2")),
+            http_server(cache(1500, "AS3"))]
+    worker = RpkiWorker(urls, str(tmpdir))
+    vrps = worker.fetch()
+    assert [vrp.asn for vrp in vrps] == ["AS2"]
+    assert worker.cache_stats["cache_selected"] == urls[1]
+    assert worker.validators["url"] == urls[1]
+    assert worker.validators["timestamp"] == 2000
+    # the same export is not processed again
+    assert worker.fetch() is None
+
+
+def test_fetch_timeout(tmpdir, http_server):
+    """Fall back to a stale cache when the freshest does not respond."""
+    urls = [http_server(cache(2000, "AS2", delay=2)),
+            http_server(cache(1000, "AS1"))]
+    worker = RpkiWorker(urls, str(tmpdir))
+    worker.timeout = 0.5
+    start = time.time()
+    vrps = worker.fetch()
+    assert time.time() - start < 1.5
+    assert [vrp.asn for vrp in vrps] == ["AS1"]
+    assert worker.cache_stats["cache_0_result"] == "timeout"
+    assert worker.cache_stats["cache_1_result"] == "ok"
+    # the session of the request still in progress is not re-used
+    assert urls[0] not in worker.sessions
+    assert urls[1] in worker.sessions
+
+
+def test_fetch_failed(tmpdir, http_server):
+    """Fail when no cache has a VRP set available."""
+    urls = [http_server(cache(2000, "AS2", status=500)),
+            http_server(cache(1000, "AS1", delay=2))]
+    worker = RpkiWorker(urls, str(tmpdir))
+    worker.timeout = 0.5
+    with pytest.raises(RuntimeError):
+        worker.fetch()
+    assert worker.cache_stats["cache_0_result"] == "error"
+    assert worker.cache_stats["cache_1_result"] == "timeout"
+    assert worker.cache_stats["cache_selected"] is None
+
+
+def test_persistent(tmpdir, http_server, monkeypatch):
+    """Run a cycle for each command, until the command channel closes."""
+    monkeypatch.setattr(RpkiWorker, "connect_eapi", lambda self: None)
+    # the worker installs its own SIGTERM handler
+    monkeypatch.setattr(signal, "signal", lambda *args: None)
+    url = http_server(cache(1000, "AS1"))
+    worker = RpkiWorker([url], str(tmpdir), persistent=True)
+    received = list()
+
+    def agent():
+        (stats, snapshot, validators) = worker.p_data.recv()
+        received.append((stats, snapshot, validators))
+        worker.p_data.send(("refresh", time.time(), validators, snapshot))
+        received.append(worker.p_data.recv())
+        worker.p_data.close()
+
+    thread = threading.Thread(target=agent)
+    thread.daemon = True
+    thread.start()
+    # returns once the agent has closed the command channel
+    worker.run()
+    thread.join(5)
+    # the error channel was closed without an error being sent
+    with pytest.raises(EOFError):
+        worker.p_err.recv()
+    ((_, snapshot, validators), (stats, update, _)) = received
+    assert snapshot is not None
+    assert validators["url"] == url
+    # the export is unchanged
+    assert update is None
+    assert stats["cache_selected"] == url
+
+
+def test_as0(tmpdir, synthetic_vrps):
+    """Re-render the covered prefix-lists only, when AS0 VRPs change."""
+    vrps = synthetic_vrps(500)
+    worker = RpkiWorker([], str(tmpdir))
+    (stats, snapshot) = worker.process(vrps)
+    assert stats["origins_affected"] == sum(len(vrps.origins(afi))
+                                            for afi in ("ipv4", "ipv6"))
+    as0 = VRPSet([VRP(asn="AS0", prefix=u"198.51.100.0/24", maxLength=24,
+                      ta=u"test")])
+    changed = VRPSet(vrps)
+    changed.update(as0, VRPSet([]))
+    worker.previous = snapshot
+    (stats, update) = worker.process(changed)
+    assert stats["origins_affected"] == 0
+    assert ("ipv4", "0") not in rendered(update)
+    covered = rendered(update)[("ipv4", None)]
+    assert b"198.51.100.0/24" in covered
+    assert rendered(snapshot)[("ipv4", None)] != covered